@@ -0,0 +1,110 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Cache of page sizes measured without the proxy."""
+
+import os
+import json
+import time
+import urlparse
+from collections import OrderedDict
+from logging import *
+
+def normalize_url(url):
+    parsed = urlparse.urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if (scheme, netloc[-3:]) == ("http", ":80") or \
+            (scheme, netloc[-4:]) == ("https", ":443"):
+        netloc = netloc.rsplit(":", 1)[0]
+    path = parsed.path or "/"
+    # the fragment never reaches the server, so it cannot change the page
+    return urlparse.urlunparse((scheme, netloc, path, parsed.params,
+                                parsed.query, ""))
+
+class UrlCache:
+    # dicts of facts about urls, kept for ttl secs. Entries are kept in
+    # least recently used first order, both in memory and in the cache
+    # file.
+    def __init__(self, filename=None, ttl=86400, max_entries=10000):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        for key, entry in self.__read():
+            self.entries[key] = entry
+
+    def __expired(self, entry, now):
+        return now - entry["loaded_at"] > self.ttl
+
+    def _key(self, url):
+        return normalize_url(url)
+
+    def get(self, url):
+        key = self._key(url)
+        entry = self.entries.pop(key, None)
+        if entry is None or self.__expired(entry, time.time()):
+            return None
+        self.entries[key] = entry
+        return entry
+
+    def _put(self, url, entry):
+        key = self._key(url)
+        self.entries.pop(key, None)
+        entry["loaded_at"] = time.time()
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __read(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return []
+        try:
+            with open(self.filename, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            warn("Ignoring unreadable cache %s: %s"
+                 % (self.filename, e))
+            return []
+
+    def save(self):
+        if not self.filename:
+            return
+        # other workers may have saved since we read the file, keep
+        # their entries unless ours are fresher
+        now = time.time()
+        merged = OrderedDict()
+        for key, entry in self.__read():
+            merged[key] = entry
+        for key, entry in self.entries.items():
+            theirs = merged.pop(key, None)
+            if theirs and theirs["loaded_at"] > entry["loaded_at"]:
+                entry = theirs
+            merged[key] = entry
+        items = [(key, entry) for key, entry in merged.items()
+                 if not self.__expired(entry, now)]
+        items = items[-self.max_entries:]
+        tmpname = "%s.%d" % (self.filename, os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump(items, f)
+        os.rename(tmpname, self.filename)
+
+class BaselineCache(UrlCache):
+    # variant names the settings, other than the url, that the sizes
+    # depend on (such as resources not loaded). Sizes measured under
+    # another variant are kept apart, and never returned by get.
+    def __init__(self, filename=None, ttl=86400, max_entries=10000,
+                 variant=""):
+        self.variant = variant
+        UrlCache.__init__(self, filename, ttl, max_entries)
+
+    def _key(self, url):
+        key = normalize_url(url)
+        if self.variant:
+            key = "%s %s" % (self.variant, key)
+        return key
+
+    def put(self, url, height, width, fingerprint=None):
+        self._put(url, {"height": height, "width": width,
+                        "fingerprint": fingerprint})
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Benchmark: runs the regression worker against a local origin and proxy."""
+
+import re
+import json
+import time
+import random
+import resource
+import argparse
+import tempfile
+import urllib2
+import multiprocessing
+from collections import deque
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import regression
+import timing
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            add_help=False)
+    parser.add_argument("-h", "--help", action="help",
+                        help="Show this help message and exit")
+    parser.add_argument("-s", "--seeds", type=int, default=10,
+            help="# of seed pages to crawl")
+    parser.add_argument("-P", "--pages", type=int, default=100,
+            help="# of distinct pages the origin serves")
+    parser.add_argument("-A", "--anchors", type=int, default=50,
+            help="# of links on every page")
+    parser.add_argument("-D", "--depth", type=int, default=20,
+            help="Nesting depth of the divs on every page")
+    parser.add_argument("-S", "--style-delay", type=int, default=200,
+            help="# of ms the origin takes to serve a stylesheet")
+    parser.add_argument("-L", "--loader-delay", type=int, default=300,
+            help="# of ms after which the proxy removes its loader div")
+    parser.add_argument("-m", "--branch-factor", type=int, default=5,
+            help="Branching factor of crawl tree")
+    parser.add_argument("-t", "--timeout", type=int, default=10,
+            help="Maximum # of secs to wait for page load")
+    parser.add_argument("-c", "--css-loadtime", type=float, default=1.5,
+            help="Maximum # of secs to wait for css to load")
+    parser.add_argument("-w", "--wait-time", type=float, default=0.0,
+            help="Average # seconds to pause between page visits "
+                 "(0 does not pause at all)")
+    parser.add_argument("-a", "--adaptive-settle", action='store_true', default=False,
+            help="Stop waiting for css once the page size stops changing")
+    parser.add_argument("-l", "--log-dir", default=None,
+            help="log directory for logs (default: a new temporary directory)")
+    parser.add_argument("-o", "--save", default=None,
+            help="File to save the results in, as JSON")
+    parser.add_argument("-b", "--baseline", default=None,
+            help="Results saved by an earlier run to compare against")
+    return parser.parse_args()
+
+class OriginHandler(BaseHTTPRequestHandler):
+    # pages are generated from their number alone, so every run
+    # serves exactly the same site
+    def do_GET(self):
+        match = re.match(r"^/page/(\d+)$", self.path)
+        if match:
+            self.send_page(int(match.group(1)))
+        elif self.path.startswith("/style.css"):
+            time.sleep(self.server.opts.style_delay/1000.0)
+            self.send_body("text/css", "p { margin: 40px 0; }\n"
+                           "li { line-height: 24px; }\n")
+        else:
+            self.send_error(404)
+
+    def send_page(self, n):
+        opts = self.server.opts
+        base = "http://%s:%d" % self.server.server_address
+        rand = random.Random(n)
+        html = ["<html><head><title>Page %d</title>" % n,
+                '<link rel="stylesheet" href="%s/style.css?page=%d">' % (base, n),
+                "</head><body>"]
+        html += ["<div>"] * opts.depth
+        html.append("<p>%s</p>" % ("lorem ipsum " * rand.randint(10, 100)))
+        html += ["</div>"] * opts.depth
+        html.append("<ul>")
+        for i in range(opts.anchors):
+            html.append('<li><a href="%s/page/%d">Link %d</a></li>'
+                        % (base, rand.randrange(opts.pages), i))
+        html.append("</ul></body></html>")
+        self.send_body("text/html", "\n".join(html))
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# what the proxy adds to every page: a loader div that goes away, and
+# a LOADED title, once the page is ready
+LOADER_HTML = """<div id="loader">Loading...</div>
+<script>
+setTimeout(function() {
+    var loader = document.getElementById('loader');
+    loader.parentNode.removeChild(loader);
+    document.title += ' - LOADED';
+}, %d);
+</script>"""
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    # prefix-style proxy: /http://host/path fetches http://host/path
+    def do_GET(self):
+        url = self.path[1:]
+        if not url.startswith("http://"):
+            self.send_error(404)
+            return
+        try:
+            response = self.server.opener.open(url)
+        except urllib2.URLError as e:
+            self.send_error(502, str(e))
+            return
+        content_type = response.info().gettype()
+        body = response.read()
+        if content_type == "text/html":
+            body = self.rewrite(body)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def rewrite(self, body):
+        prefix = "http://%s:%d/" % self.server.server_address
+        body = re.sub(r'(href|src)="(http://[^"]*)"',
+                      lambda m: '%s="%s%s"' % (m.group(1), prefix, m.group(2)),
+                      body)
+        loader = LOADER_HTML % self.server.opts.loader_delay
+        return body.replace("<body>", "<body>" + loader, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(handler, opts):
+    # serve from a separate process so that the servers neither compete
+    # with the GTK main loop nor count towards the harness's memory
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.opts = opts
+    # the proxy fetches from the origin directly, whatever http_proxy
+    # says
+    server.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    server.socket.close()
+    return "http://%s:%d" % server.server_address, process
+
+def loaded_pages():
+    return sum(len(secs)
+               for phase in (timing.LOADED, "baseline." + timing.LOADED)
+               for secs in regression.timer.samples[phase].values())
+
+def run_benchmark(opts):
+    origin, origin_process = start_server(OriginHandler, opts)
+    proxy, proxy_process = start_server(ProxyHandler, opts)
+    log_dir = opts.log_dir or tempfile.mkdtemp(prefix="regression-bench-")
+    regression.args = regression.parse_args([
+        "--id", "bench",
+        "--run-id", regression.new_run_id(),
+        "--proxy", proxy,
+        "--branch-factor", str(opts.branch_factor),
+        "--timeout", str(opts.timeout),
+        "--css-loadtime", str(opts.css_loadtime),
+        "--wait-time", str(opts.wait_time),
+        # think times are drawn around --wait-time, even when it is 0
+        "--think-scale", "1" if opts.wait_time else "0",
+        "--log-dir", log_dir,
+        # the baseline cache would make repeated runs incomparable
+        "--baseline-ttl", "0",
+        # as would skipping links, the benchmark pages all link to the
+        # same few pages
+        "--visited-capacity", "0"] +
+        (["--adaptive-settle"] if opts.adaptive_settle else []))
+    seeds = deque("%s/page/%d" % (origin, n) for n in range(opts.seeds))
+
+    # the same think times on every run
+    random.seed(0)
+    start = time.time()
+    regression.run_worker("bench", lambda: seeds.popleft() if seeds else None)
+    elapsed = time.time() - start
+
+    origin_process.terminate()
+    proxy_process.terminate()
+    pages = loaded_pages()
+    return {"pages": pages,
+            "elapsed": elapsed,
+            "pages_per_sec": pages / elapsed,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "phases": regression.timer.summary(),
+            "log_dir": log_dir}
+
+def print_results(result, baseline=None):
+    def compare(key, value):
+        if baseline is None or baseline.get(key) is None:
+            return ""
+        old = baseline[key]
+        return " (baseline %.3f, %+.1f%%)" % (old, (value - old) * 100.0 / old) \
+            if old else " (baseline %.3f)" % old
+    print("pages loaded: %d in %.1fs" % (result["pages"], result["elapsed"]))
+    print("pages/sec: %.3f%s" % (result["pages_per_sec"],
+                                 compare("pages_per_sec", result["pages_per_sec"])))
+    print("peak RSS: %d KB%s" % (result["peak_rss_kb"],
+                                 compare("peak_rss_kb", result["peak_rss_kb"])))
+    old_phases = baseline["phases"] if baseline else {}
+    for phase, (n, p50, p95, p99, top) in sorted(result["phases"].items()):
+        line = "%s: n=%d p50=%.0fms p95=%.0fms p99=%.0fms max=%.0fms" % (
+            phase, n, p50*1000, p95*1000, p99*1000, top*1000)
+        if phase in old_phases:
+            line += " (baseline p50=%.0fms p95=%.0fms)" % (
+                old_phases[phase][1]*1000, old_phases[phase][2]*1000)
+        print(line)
+    print("logs: %s" % result["log_dir"])
+
+if __name__ == '__main__':
+    opts = parse_args()
+    baseline = None
+    if opts.baseline:
+        with open(opts.baseline, "r") as f:
+            baseline = json.load(f)
+    result = run_benchmark(opts)
+    print_results(result, baseline)
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump(result, f, indent=2)
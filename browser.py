@@ -21,66 +21,232 @@ from collections import deque
 from logging import *
 import gobject
 import signal
-import urlparse
+import json
+import results
+import timing
+import layout
+import signatures
 
 class TimeoutException(Exception): 
     pass 
 
+# in adaptive settle mode the page's styles are taken to be applied once
+# the document size has stayed the same for SETTLE_FRAMES samples taken
+# SETTLE_FRAME_MS apart
+SETTLE_FRAME_MS = 50
+SETTLE_FRAMES = 3
+
+# attribute set on the root element of documents whose mutation events
+# a browser is listening to, removed again when it stops listening
+LISTENING_ATTR = "data-regression-listening"
+
+# functions available to the scripts built by probe_script(). Each
+# returns what it finds in one go, so that the page is examined with a
+# single round trip into the WebView instead of one per DOM attribute.
+PROBE_FUNCTIONS = """
+function loader() {
+    var divs = document.getElementsByTagName('div');
+    for (var i = 0; i < divs.length; i++)
+        if (divs[i].id.indexOf('loader') != -1)
+            return true;
+    return false;
+}
+function anchors() {
+    // links to other pages in document order, and the position of the
+    // first anchor for every href
+    var links = [], index = {};
+    var elems = document.getElementsByTagName('a');
+    for (var i = 0; i < elems.length; i++) {
+        var a = elems[i];
+        if (!(a.href in index))
+            index[a.href] = i;
+        if (a.hasAttribute('href') && a.href.indexOf('http') != -1 &&
+            (a.host != location.host || a.pathname != location.pathname))
+            links.push(a.href);
+    }
+    return {links: links, index: index};
+}
+function state(withLinks) {
+    var s = {loader: loader(), title: document.title, url: document.URL,
+             height: document.height, width: document.width};
+    if (withLinks)
+        s.links = anchors().links;
+    return s;
+}
+"""
+
+def probe_script(expression):
+    return "(function() {%s return %s; })()" % (PROBE_FUNCTIONS, expression)
+
+LOADER_JS = probe_script("loader()")
+ANCHORS_JS = probe_script("anchors()")
+STATE_JS = probe_script("state(false)")
+STATE_LINKS_JS = probe_script("state(true)")
+SIZE_JS = probe_script("[document.height, document.width]")
+
+# kinds of subresources that can be kept from loading, as glob patterns
+# of their uris, or "||domain" for those on domain or its subdomains.
+# None of them are stylesheets or scripts, which decide the layout the
+# tests look at.
+def _extensions(*exts):
+    return sum([["*.%s" % ext, "*.%s?*" % ext] for ext in exts], [])
+
+BLOCKABLE_RESOURCES = {
+    "images": _extensions("png", "jpg", "jpeg", "gif", "webp", "bmp", "ico"),
+    "media": _extensions("mp4", "webm", "ogg", "ogv", "mp3", "m4a", "flv",
+                         "swf", "avi", "mov"),
+    "trackers": ["||google-analytics.com", "||googletagmanager.com",
+                 "||doubleclick.net", "||googlesyndication.com",
+                 "||scorecardresearch.com", "||quantserve.com",
+                 "||chartbeat.com", "||chartbeat.net", "||adnxs.com",
+                 "||omtrdc.net", "||facebook.net"],
+}
+
+# patterns for the uris of the given kinds of resources
+def resource_patterns(kinds, extra_patterns=()):
+    patterns = list(extra_patterns)
+    for kind in kinds:
+        patterns += BLOCKABLE_RESOURCES[kind]
+    return patterns
+
+def rss_mb():
+    # resident set size of this process, 0 if it cannot be told
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, ValueError, IndexError):
+        return 0
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
 def randstr(l = 32):
     return "".join(["%.2x" % random.randint(0, 0xFF) for i in range(l/2)])
 
 class DOMWalker:
-    def __init__(self, branch_factor):
+    # collects the urls of up to branch_factor links below a node, in
+    # document order. The walk stops as soon as it has them, and goes at
+    # most max_depth levels down and on for at most max_secs (0 means no
+    # limit). Only nodes named in tags, if given, are passed to the
+    # callback, but the walk still descends through the others.
+    def __init__(self, branch_factor, tags=None, max_depth=0, max_secs=0):
         self.__indent = 0
         self.branch_factor = branch_factor
+        self.tags = tags and set(tags)
+        self.max_depth = max_depth
+        self.max_secs = max_secs
         self.child_urls = []
 
+    # returns True once the walk can stop
     def __dump(self, node):
-        i = 0
         #print >> sys.stderr,  " "*self.__indent, node.__class__.__name__
         if node.nodeName == "A" and self.branch_factor > 0:
-            #print >> sys.stderr,  " "*self.__indent, node.__class__.__name__
             if node.hasAttribute("href") and  node.__getattribute__("href").find("http") != -1:
                 #print >> sys.stderr,  "  "*self.__indent, node.__getattribute__("href")
                 urlval = node.__getattribute__("href")
                 self.child_urls.append(urlval)
-                #print >> sys.stderr,  "  "*self.__indent, "http://safly-beta.dyndns.org/?q="+node.__getattribute__("href")
-                #print >> sys.stderr,  "  "*self.__indent, node.nodeName
                 self.branch_factor -= 1
+        return self.branch_factor < 1
 
+    # calls callback(node, *args, **kwargs) on node and the nodes below
+    # it, depth first without recursing, until it returns True
     def walk_node(self, node, callback = None, *args, **kwargs):
         if callback is None:
             callback = self.__dump
-
-        callback(node, *args, **kwargs)
-        self.__indent += 1
-        children = node.childNodes
-        for i in range(children.length):
-            child = children.item(i)
-            self.walk_node(child, callback, *args, **kwargs)
-            self.__indent -= 1
+        deadline = self.max_secs and time.time() + self.max_secs
+        # (node, depth) of the nodes left to visit, the next one last
+        stack = [(node, 0)]
+        while stack:
+            node, self.__indent = stack.pop()
+            if not self.tags or node.nodeName in self.tags:
+                if callback(node, *args, **kwargs):
+                    return
+            if deadline and time.time() > deadline:
+                warn("DOM walk stopped after %.1fs" % self.max_secs)
+                return
+            if self.max_depth and self.__indent >= self.max_depth:
+                continue
+            children = node.childNodes
+            for i in reversed(range(children.length)):
+                stack.append((children.item(i), self.__indent + 1))
 
 
 class Browser():
-    def __init__(self, branch_factor=0, verbose_output=False, no_proxy=False, css_loadtime=1.5):
+    def __init__(self, branch_factor=0, verbose_output=False, no_proxy=False, css_loadtime=1.5,
+                 result_store=None, timer=None, adaptive_settle=False,
+                 block_patterns=()):
         self.branch_factor = branch_factor
+        # ResultStore console errors and script alerts are recorded in
+        self.result_store = result_store
+        # PhaseTimer the phases of every navigation are recorded in
+        self.timer = timer
         self.verbose_output = verbose_output
         self.css_loadtime = css_loadtime
+        # stop waiting for css as soon as the layout is stable, with
+        # css_loadtime as the upper bound
+        self.adaptive_settle = adaptive_settle
+        # glob patterns of subresource uris not to load, see
+        # resource_patterns()
+        self.block_patterns = list(block_patterns)
         #to indicate that it is a no proxy browser
         self.no_proxy = no_proxy
         self.__bid = randstr(16)
-        self.__webkit = webkit.WebView()
-        self.__webkit.SetConsoleMessageCallback(self._console_message)
-        self.__webkit.SetScriptAlertCallback(self._script_alert)
-        self.__webkit.SetDocumentLoadedCallback(self._DOM_ready)
+        # bound once, so that the very same listeners can be removed
+        self.__listeners = [
+            ('DOMNodeInserted', self._DOM_node_inserted),
+            ('DOMNodeRemoved', self._DOM_node_removed),
+            ('DOMAttrModified', self._DOM_node_attr_modified),
+            ('DOMCharacterDataModified', self._DOM_node_data_modified)]
+        self.__listened_document = None
+        # pages loaded by the current WebView, see recycle()
+        self.navigations = 0
+        self.__webkit = None
+        self.__new_webview()
         self.result = None
         self.tid = None
         self.timed_out = None
+        self.dom_loaded = False
+        self.pageLoaded = False
+        self.loader_present = False
+        # the proxy's loader showed up on the page being loaded
+        self.loader_seen = False
+        self.load_done_at = None
+        self.__load_condition = None
+        self.__waiting = False
+        self.__nav_url = None
+        self.__nav_start = None
+        self.__nav_marks = set()
+        # the current document's anchors() probe, see __anchors();
+        # reset whenever the browser navigates
+        self.__anchor_index = None
         info("Spawned new browser " + str(self.__bid))
 
     def __del__(self):
         pass
 
+    def __new_webview(self):
+        self.__webkit = webkit.WebView()
+        self.__webkit.SetConsoleMessageCallback(self._console_message)
+        self.__webkit.SetScriptAlertCallback(self._script_alert)
+        self.__webkit.SetDocumentCommittedCallback(self._DOM_committed)
+        self.__webkit.SetDocumentLoadedCallback(self._DOM_ready)
+        if self.block_patterns:
+            self.__webkit.SetResourceFilter(self.block_patterns)
+
+    # replace the WebView with a new one, freeing whatever the old one
+    # accumulated. Its history goes with it, so only recycle between
+    # crawls.
+    def recycle(self):
+        info("Recycling browser %s after %d navigations"
+             % (self.__bid, self.navigations))
+        if self.tid:
+            gobject.source_remove(self.tid)
+            self.tid = None
+        self.__load_condition = None
+        self.__anchor_index = None
+        self.__listened_document = None
+        self.__webkit.Destroy()
+        self.__new_webview()
+        self.navigations = 0
+
     def __timeout_callback(self):
         debug("Timeout Callback")
         if gtk.main_level() > 0:
@@ -93,50 +259,141 @@ class Browser():
         # the primary thread.
         # Don't do this: raise TimeoutException
 
+    def __arm_timeout(self, timeout):
+        if self.tid:
+            gobject.source_remove(self.tid)
+        self.timed_out = False
+        self.tid = gobject.timeout_add(timeout*1000, self.__timeout_callback)
+
+    # whether the page being navigated to has loaded. Unproxied, once
+    # its document is ready. Proxied, once the proxy's loading image has
+    # come and gone or the page's title says LOADED, whichever is first;
+    # the proxy removes its loader long before onload on pages full of
+    # ads. A proxied page that never shows the loader is loaded once its
+    # document is ready.
+    def __page_loaded(self):
+        if self.no_proxy:
+            return self.dom_loaded
+        return self.pageLoaded or (not self.loader_present and
+                                   (self.loader_seen or self.dom_loaded))
+
+    def __expect_load(self, timeout):
+        # the page counts as loaded once __page_loaded holds; it is
+        # checked from the load callbacks, so the load progresses (and
+        # its time is recorded) whenever the GTK main loop runs, even
+        # before anybody waits for it
+        self.pageLoaded = False
+        self.dom_loaded = False
+        self.loader_present = False
+        self.loader_seen = False
+        self.__anchor_index = None
+        self.__arm_timeout(timeout)
+        self.load_done_at = None
+        self.__load_condition = self.__page_loaded
+
+    def __start_navigation(self, url):
+        self.__nav_url = url
+        self.__nav_start = time.time()
+        self.__nav_marks = set()
+
+    def __phase_url(self):
+        # go back does not know where it is going until it gets there
+        return self.__nav_url or self.getUrl()
+
+    def __record(self, phase, secs):
+        if self.no_proxy:
+            phase = "baseline." + phase
+        self.timer.record(self.__phase_url(), phase, secs)
+
+    def __mark(self, phase):
+        # record how long after the request the navigation reached
+        # phase, the first time it does
+        if self.timer and self.__nav_start and phase not in self.__nav_marks:
+            self.__nav_marks.add(phase)
+            self.__record(phase, time.time() - self.__nav_start)
+
+    def __load_event(self):
+        # called from the DOM/load callbacks whenever the load state
+        # changes; wakes up __wait_for_load once its condition holds
+        if self.__load_condition and self.__load_condition():
+            self.__load_condition = None
+            self.load_done_at = time.time()
+            self.__mark(timing.LOADED)
+            # Disable the timeout
+            if self.tid:
+                gobject.source_remove(self.tid)
+                self.tid = None
+            if self.__waiting:
+                self.quitgtk()
+
+    def __wait_for_load(self):
+        # run the GTK main loop until a load event satisfies the
+        # expected condition or the timeout callback fires. Callbacks
+        # of other browsers may quit the loop too, so the state is
+        # re-checked on every wakeup.
+        info("Waiting For Page to Get Loaded")
+        self.__load_event()
+        self.__waiting = True
+        while not self.timed_out and self.load_done_at is None:
+            gtk.main()
+        self.__waiting = False
+        if self.timed_out:
+            self.__load_condition = None
+            raise TimeoutException
+        # wait time for stylesheet to get loaded
+        self.settle(self.css_loadtime*1000)
+        return True
+
     #if loading a page taked more than timeout miliseconds
     #visit will timout. Default timeout value is 5000
     def visit(self, url, timeout=5):
+        self.start_visit(url, timeout)
+        return self.wait_visit()
+
+    # start loading url without waiting for it, so that several
+    # browsers can load pages at the same time. wait_visit() completes
+    # the visit.
+    def start_visit(self, url, timeout=5):
         info("Visiting URL: " + url)
+        self.navigations += 1
+        self.__start_navigation(url)
         document = self.__webkit.GetDomDocument()
         document.title = " - LOADING"
-        timeout_ms = timeout*1000
-        self.timed_out = False
-        self.tid = gobject.timeout_add(timeout_ms, self.__timeout_callback)
-        self.pageLoaded = False
-        if self.no_proxy:
-            self.dom_loaded =False
+        self.__expect_load(timeout)
         self.__webkit.LoadDocument(url)
-        
-        # we are waiting for image loader to appear
-        # dont decrease this value
-        self.gtk_sleep(500)
-      
-        # wait for page to get load
-        # if browser is no proxy browser then wait for 
-        # dom to get loaded
-        # else we wait for loading image from proxy to get 
-        # disappeared
-        info("Waiting For Page to Get Loaded")
-        if self.no_proxy:
-            while not self.dom_loaded:
-                self.gtk_sleep(100)
-                if self.timed_out:
-                    break;
-        else:
-            while self.checkDiv():
-                self.gtk_sleep(100)
-                if self.timed_out:
-                    break;
-        # wait time for stylesheet to get loaded
-        self.gtk_sleep(self.css_loadtime*1000)
-        # Disable the timeout
-        if self.tid:
-            gobject.source_remove(self.tid)
-            self.tid = None
-        if self.timed_out:
-            raise TimeoutException
-        else:
-            return True
+
+    # with a timeout, the page gets that many secs from now on to load
+    # instead of from when start_visit was called
+    def wait_visit(self, timeout=None):
+        if timeout and self.__load_condition:
+            self.__arm_timeout(timeout)
+        return self.__wait_for_load()
+
+    # sleep until ms milliseconds have passed since the current page
+    # finished loading, or in adaptive mode until its layout is stable
+    def settle(self, ms, phase=timing.CSS_SETTLE):
+        start = time.time()
+        deadline = self.load_done_at + ms/1000.0
+        if self.adaptive_settle:
+            self.__settle_layout(deadline)
+        elif deadline > start:
+            self.gtk_sleep((deadline - start)*1000)
+        if self.timer:
+            self.__record(phase, time.time() - start)
+
+    def __settle_layout(self, deadline):
+        last = None
+        stable = 0
+        while time.time() < deadline:
+            size = self.getDocumentSize()
+            if size == last:
+                stable += 1
+                if stable >= SETTLE_FRAMES:
+                    break
+            else:
+                last = size
+                stable = 0
+            self.gtk_sleep(min(SETTLE_FRAME_MS, (deadline - time.time())*1000))
 
     def url(self):
         window = self.__webkit.GetDomWindow()
@@ -148,6 +405,11 @@ class Browser():
         # DocumentType, EntityReference, ProcessingInstruction
         parent = event.relatedNode
         #print >> sys.stderr,  "NODE INSERTED", target, parent
+        if (parent and parent.nodeName == "TITLE") or target.nodeName == "TITLE":
+            self.__check_title()
+        elif not self.no_proxy and self.__has_loader(target):
+            self.loader_present = True
+            self.loader_seen = True
 
     def _DOM_node_removed(self, event):
         target = event.target
@@ -155,6 +417,12 @@ class Browser():
         # DocumentType, EntityReference, ProcessingInstruction
         parent = event.relatedNode
         #print >> sys.stderr,  "NODE REMOVED", target, parent
+        # the event is dispatched before the node leaves the tree, so
+        # look at the removed subtree rather than the whole document
+        if self.loader_present and self.__has_loader(target):
+            self.loader_present = False
+            self.__mark(timing.LOADER_GONE)
+            self.__load_event()
 
     def _DOM_node_attr_modified(self, event):
         target = event.target
@@ -173,6 +441,9 @@ class Browser():
         newval = event.newValue
         oldval = event.prevValue
         #print >> sys.stderr,  "NODE DATA MODIFIED", target, newval, oldval, parent
+        if parent and parent.nodeName == "TITLE":
+            self.__check_title()
+            return
         #print >> sys.stderr,  dir(target)
         #print >> event.target.getElementsByTagName('div').nodeName
         #print >> event.target.attributes[0].nodeName
@@ -194,99 +465,116 @@ class Browser():
 
         #print dir(event.target)
 
+    def _is_Page_Loaded(self):
+        self.pageLoaded = True
+        self.__mark(timing.TITLE_LOADED)
+        self.__load_event()
+
+    def __check_title(self):
+        document = self.__webkit.GetDomDocument()
+        if document.title.find("LOADED") >= 0:
+            self._is_Page_Loaded()
+
+    def __has_loader(self, node):
+        # true if node is, or contains, the proxy's loading image div
+        if node.nodeType != 1:
+            return False
+        divElemList = [node] if node.nodeName == "DIV" else []
+        divs = node.getElementsByTagName("div")
+        divElemList += [divs.item(i) for i in range(divs.length)]
+        for div in divElemList:
+            if div.hasAttribute("id") and div.__getattribute__("id").find("loader") != -1:
+                return True
+        return False
+
+    # the new document of a navigation exists, though little or none of
+    # it is parsed yet. Listening to it from here on sees the proxy's
+    # loader and the LOADED title as soon as they appear.
+    def _DOM_committed(self):
+        self.__listen(self.__webkit.GetDomDocument())
+        self.__anchor_index = None
+        state = self.Probe()
+        if state:
+            if state["loader"] and not self.no_proxy:
+                self.loader_present = True
+                self.loader_seen = True
+            if state["title"].find("LOADED") >= 0:
+                self._is_Page_Loaded()
+        self.__load_event()
+
     def _DOM_ready(self):
         document = self.__webkit.GetDomDocument()
         window = self.__webkit.GetDomWindow()
-        document.addEventListener('DOMNodeInserted', self._DOM_node_inserted,
-                                        False)
-        document.addEventListener('DOMNodeRemoved', self._DOM_node_removed,
-                                        False)
-        document.addEventListener('DOMAttrModified', self._DOM_node_attr_modified,
-                                        False)
-        document.addEventListener('DOMCharacterDataModified', self._DOM_node_data_modified,
-                                        False)
+        self.__listen(document)
         print >> sys.stderr,  "URL:", document.URL
         print >> sys.stderr,  "Title:", document.title
         print >> sys.stderr,  "Cookies:", document.cookie
-        if self.no_proxy:
-            self.dom_loaded =True
+        self.__anchor_index = None
+        # pick up whatever happened to the new document before its
+        # listeners were attached
+        self.__mark(timing.DOM_READY)
+        state = self.Probe()
+        self.loader_present = state["loader"]
+        if not self.loader_present and not self.no_proxy:
+            self.__mark(timing.LOADER_GONE)
+        if state["title"].find("LOADED") >= 0:
+            self._is_Page_Loaded()
+        self.dom_loaded = True
+        self.__load_event()
+
 
+    # load-finished also fires for frames of a document we are already
+    # listening to, so only add the listeners to a document once, and
+    # take them off the previous one. A just committed document may not
+    # have its root element to mark yet, it is listened to again once
+    # it is ready, which takes the listeners off it before adding them
+    # back.
+    def __listen(self, document):
+        root = document.documentElement
+        if root is not None and root.getAttribute(LISTENING_ATTR) == self.__bid:
+            return
+        if self.__listened_document is not None:
+            for event, listener in self.__listeners:
+                self.__listened_document.removeEventListener(event, listener,
+                                                             False)
+            # the document may come back from the page cache, on going
+            # back, and must get its listeners again then
+            old_root = self.__listened_document.documentElement
+            if old_root is not None:
+                old_root.removeAttribute(LISTENING_ATTR)
+        if root is not None:
+            root.setAttribute(LISTENING_ATTR, self.__bid)
+        for event, listener in self.__listeners:
+            document.addEventListener(event, listener, False)
+        self.__listened_document = document
 
     def JsMouseClickEvent(self,elemid,timeout=5):
         oldURL = self.getUrl()
-        timeout_ms = timeout*1000
-        self.timed_out = False
-        self.tid = gobject.timeout_add(timeout_ms, self.__timeout_callback)
-        self.pageLoaded = False
+        self.navigations += 1
+        self.__start_navigation(elemid)
         document = self.__webkit.GetDomDocument()
         document.title = " - LOADING"
+        self.__expect_load(timeout)
         # Execute JS code
         script = "var evt = document.createEvent('MouseEvents');\
                      evt.initMouseEvent('click', true, true, document.defaultView, 1, 0, 0, 0, 0, false, false, false, false, 0, null);\
                      document.getElementById('"+elemid+"').dispatchEvent(evt);";
         self.__webkit.ExecuteJsScript(script);
-        
-        self.gtk_sleep(5)
-        info("Waiting For Page to Get Loaded")
-        while True:
-            document = self.__webkit.GetDomDocument()
-            #info("Title: "+document.title)
-            #if document.URL != oldURL:
-            if document.title.find("LOADED") >=0:
-                break;
-            #info("waitforclicktofinish: "+ document.URL)
-            self.gtk_sleep(100)
-            if self.timed_out:
-                break;
-
-        # wait time for stylesheet to get loaded
-        self.gtk_sleep(self.css_loadtime*1000)
-        
-        # Disable the timeout
-        if self.tid:
-            gobject.source_remove(self.tid)
-            self.tid = None
-        if self.timed_out:
-            raise TimeoutException
-        else:
-            return True
+        return self.__wait_for_load()
     
     def JsGoBack(self,timeout=5):
         oldURL = self.getUrl()
-        timeout_ms = timeout*1000
-        self.timed_out = False
-        self.tid = gobject.timeout_add(timeout_ms, self.__timeout_callback)
-        self.pageLoaded = False
+        self.navigations += 1
+        self.__start_navigation(None)
         document = self.__webkit.GetDomDocument()
         document.title = " - LOADING"
+        self.__expect_load(timeout)
         # Execute JS code
         script = "history.go(-1)";
         self.__webkit.ExecuteJsScript(script);
-        
+
         # wait for page to load
-        self.gtk_sleep(5)
-        info("Waiting For Page to Get Loaded")
-        while True:
-            document = self.__webkit.GetDomDocument()
-            #if document.URL != oldURL:
-            if document.title.find("LOADED") >=0:
-                break;
-            #info("waitforgobackfinish: "+ document.URL)
-            self.gtk_sleep(100)
-            if self.timed_out:
-                break;
-       
-        # wait time for stylesheet to get loaded
-        self.gtk_sleep(self.css_loadtime*1000)
-        
-        # Disable the timeout
-        if self.tid:
-            gobject.source_remove(self.tid)
-            self.tid = None
-        if self.timed_out:
-            raise TimeoutException
-        else:
-            return True
+        return self.__wait_for_load()
         
     
 
@@ -296,6 +584,9 @@ class Browser():
         if (message.find("failed") or message.find("error")) >= 0:
             #print >> sys.stderr, "console log: ",message
             error("console message: "+message)
+            if self.result_store:
+                self.result_store.record(results.CONSOLE_ERROR, self.getUrl(),
+                                    results.FAIL, message=message)
         else:
             #pass
             if self.verbose_output:
@@ -304,32 +595,48 @@ class Browser():
     def _script_alert(self,message):
         # any alert box is treated as an error
         error("script alert: "+message)
+        if self.result_store:
+            self.result_store.record(results.SCRIPT_ALERT, self.getUrl(),
+                                results.FAIL, message=message)
         #print >> sys.stderr, "script alert: ",message
 
     # return an anchor element whose href attribute 
     # value is equal to url argument. if not such element
     # return -1
     def GetAnchorElement(self,url):
-        document = self.__webkit.GetDomDocument()
-        urlElemList = document.getElementsByTagName("A")
-        for i in range(urlElemList.length):
-            node = urlElemList.item(i)
-            if node.__getattribute__("href") == url:
+        for fresh in (False, True):
+            position = self.__anchors(fresh)["index"].get(url)
+            if position is None:
+                return -1
+            node = self.__webkit.GetDomDocument().getElementsByTagName("A").item(position)
+            # the page may have changed its anchors since they were indexed
+            if node is not None and node.__getattribute__("href") == url:
                 return node
         return -1
 
     def GetUrlList(self, urllist):
-        document = self.__webkit.GetDomDocument()
-        urlElemList = document.getElementsByTagName("A")
-        for i in range(urlElemList.length):
-            node = urlElemList.item(i)
-            if node.hasAttribute("href") and  node.__getattribute__("href").find("http") != -1:
-                urlval = node.__getattribute__("href")
-                parsedUrl = urlparse.urlparse(urlval)
-                parsedDocUrl = urlparse.urlparse(document.URL)
-                # we add the url to the list only when it points to different page
-                if (parsedUrl.netloc != parsedDocUrl.netloc) or (parsedUrl.path != parsedDocUrl.path):
-                    urllist.append(urlval)
+        urllist.extend(self.__anchors()["links"])
+
+    # examine the document's anchors once, in the page, and remember
+    # both the list of links to other pages (in DOM order) and the
+    # position of the first anchor for every href, so that looking up
+    # a clicked link does not walk the anchors again
+    def __anchors(self, fresh=False):
+        if self.__anchor_index is None or fresh:
+            self.__anchor_index = self.evaluate(ANCHORS_JS)
+        return self.__anchor_index
+
+    # evaluate script in the page and return its value
+    def evaluate(self, script):
+        result = self.__webkit.EvaluateJs(script)
+        if result is None:
+            return None
+        return json.loads(result)
+
+    # the loader state, title, url and document dimensions of the
+    # current page, and optionally its links, fetched in one call
+    def Probe(self, links=False):
+        return self.evaluate(STATE_LINKS_JS if links else STATE_JS)
 
     def getUrl(self):
         document = self.__webkit.GetDomDocument()
@@ -338,24 +645,23 @@ class Browser():
     #check if loading image is still present or not
     #when this image is not present we assume page is loaded
     def checkDiv(self):
-        document = self.__webkit.GetDomDocument()
-        divElemList = document.getElementsByTagName("div")
-        for i in range(divElemList.length):
-            node = divElemList.item(i)
-            divid = node.__getattribute__("id")
-            #print "divid: ",divid
-            if node.hasAttribute("id") and  node.__getattribute__("id").find("loader") != -1: 
-                return True
-        return False
+        return self.evaluate(LOADER_JS)
     
     def quitgtk(self):
         if gtk.main_level() > 0:
             gtk.mainquit()
 
-    def gtk_sleep(self,time):
-        tid = gobject.timeout_add(int (time), self.quitgtk)
-        gtk.main()
-        gobject.source_remove(tid)
+    def gtk_sleep(self,ms):
+        # callbacks of other browsers may quit the main loop early,
+        # so keep running it until the full time has passed
+        deadline = time.time() + ms/1000.0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            tid = gobject.timeout_add(int(remaining*1000) or 1, self.quitgtk)
+            gtk.main()
+            gobject.source_remove(tid)
     
     def getDocumentHeight(self):
         document = self.__webkit.GetDomDocument()
@@ -371,5 +677,48 @@ class Browser():
         except:
             return None
     
+    # (height, width) of the document
+    def getDocumentSize(self):
+        height, width = self.evaluate(SIZE_JS)
+        return height, width
+
+    # see layout.FINGERPRINT_JS
+    def getLayoutFingerprint(self):
+        return self.evaluate(layout.FINGERPRINT_JS)
+
+    def getPageSignature(self):
+        return self.evaluate(signatures.SIGNATURE_JS)
+
     def GetDocument(self):
         return self.__webkit.GetDomDocument()
+
+class BrowserPool:
+    # keeps the memory of a worker's browsers bounded by recycling their
+    # WebViews once they have loaded max_navigations pages, or all of
+    # them once the process has grown by max_rss_mb since they were last
+    # recycled all together (0 disables either check). maintain() must
+    # only be called between crawls.
+    def __init__(self, max_navigations=500, max_rss_mb=0):
+        self.max_navigations = max_navigations
+        self.max_rss_mb = max_rss_mb
+        self.browsers = []
+        # freed memory mostly stays with the process, so growth is
+        # measured from the RSS right after the last recycling
+        self.__base_rss = rss_mb()
+
+    def add(self, browser):
+        self.browsers.append(browser)
+        return browser
+
+    def maintain(self):
+        rss = rss_mb()
+        too_big = self.max_rss_mb and rss - self.__base_rss > self.max_rss_mb
+        if too_big:
+            info("Process RSS %d MB has grown by over %d MB since %d MB"
+                 % (rss, self.max_rss_mb, self.__base_rss))
+        for browser in self.browsers:
+            if too_big or (self.max_navigations and
+                           browser.navigations >= self.max_navigations):
+                browser.recycle()
+        if too_big:
+            self.__base_rss = rss_mb()
@@ -0,0 +1,86 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Progress of a run, for resuming it after a crash."""
+
+import os
+import json
+from collections import defaultdict
+
+LINK = "link"
+DONE = "done"
+
+def _events(filename):
+    if not os.path.exists(filename):
+        return
+    with open(filename, "r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the last line of a worker killed while writing it
+                continue
+
+# the progress recorded in a checkpoint file, as the set of seeds
+# crawled completely and a dict of seed -> set of links on it tested
+def read_checkpoint(filename):
+    done = set()
+    tested = defaultdict(set)
+    for event in _events(filename):
+        if event["event"] == LINK:
+            tested[event["seed"]].add(event["url"])
+        elif event["event"] == DONE:
+            done.add(event["seed"])
+            tested.pop(event["seed"], None)
+    return done, tested
+
+# every seed and link a checkpoint file records as tested, whether its
+# seed is done or not
+def tested_urls(filename):
+    for event in _events(filename):
+        yield event["seed"]
+        if event["event"] == LINK:
+            yield event["url"]
+
+class Checkpoint:
+    # appends the progress of a run to filename as lines of JSON:
+    #   {"event": "link", "seed": url, "url": url} once a link is tested
+    #   {"event": "done", "seed": url} once a seed is crawled
+    # urls are stored without the proxy prefix. Workers of a run share
+    # the file, every event is a single write so that theirs do not
+    # interleave. With resume, the progress already in the file is read
+    # first.
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.done = set()
+        self.tested = defaultdict(set)
+        if resume:
+            self.done, self.tested = read_checkpoint(filename)
+        self.__file = open(filename, "a+")
+        self.__file.seek(0, os.SEEK_END)
+        if self.__file.tell():
+            self.__file.seek(-1, os.SEEK_END)
+            if self.__file.read(1) != "\n":
+                # end the line a killed worker left unfinished
+                self.__write_line("")
+
+    def __write_line(self, line):
+        self.__file.seek(0, os.SEEK_END)
+        self.__file.write(line + "\n")
+        self.__file.flush()
+
+    def __write(self, event):
+        self.__write_line(json.dumps(event, separators=(",", ":")))
+
+    def link_tested(self, seed, url):
+        self.tested[seed].add(url)
+        self.__write({"event": LINK, "seed": seed, "url": url})
+
+    def seed_done(self, seed):
+        self.done.add(seed)
+        self.tested.pop(seed, None)
+        self.__write({"event": DONE, "seed": seed})
+
+    def close(self):
+        self.__file.close()
@@ -0,0 +1,101 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Layout fingerprints of pages, and comparing them."""
+
+# number of top-level blocks a fingerprint keeps the boxes of
+MAX_BLOCKS = 32
+# text nodes are counted in buckets of log2 of their length
+TEXT_BUCKETS = 12
+
+# evaluates, in one pass over the page, to
+#   {"height": h, "width": w, "anchors": n,
+#    "blocks": [[tag, left, top, width, height], ...],
+#    "text": [count of text nodes of length 1, 2-3, 4-7, ...]}
+# The blocks are the children of the first element below <body> that
+# has more than one visible child, so that wrapper divs do not hide
+# the page's structure.
+FINGERPRINT_JS = """(function() {
+    var body = document.body;
+    if (!body)
+        return null;
+    function visible(elem) {
+        var r = elem.getBoundingClientRect();
+        return r.width > 0 || r.height > 0;
+    }
+    function visibleChildren(elem) {
+        var result = [];
+        for (var i = 0; i < elem.children.length; i++)
+            if (visible(elem.children[i]))
+                result.push(elem.children[i]);
+        return result;
+    }
+    var children = visibleChildren(body);
+    while (children.length == 1 && visibleChildren(children[0]).length)
+        children = visibleChildren(children[0]);
+    var blocks = [];
+    for (var i = 0; i < children.length && i < %(max_blocks)d; i++) {
+        var r = children[i].getBoundingClientRect();
+        blocks.push([children[i].tagName.toLowerCase(),
+                     Math.round(r.left + window.scrollX),
+                     Math.round(r.top + window.scrollY),
+                     Math.round(r.width), Math.round(r.height)]);
+    }
+    var text = [];
+    for (var i = 0; i < %(text_buckets)d; i++)
+        text.push(0);
+    var walker = document.createTreeWalker(body, NodeFilter.SHOW_TEXT,
+                                           null, false);
+    var node;
+    while ((node = walker.nextNode())) {
+        var length = node.nodeValue.replace(/\\s+/g, ' ').trim().length;
+        if (length)
+            text[Math.min(Math.floor(Math.log(length) / Math.LN2),
+                          %(text_buckets)d - 1)]++;
+    }
+    return {height: document.height, width: document.width,
+            anchors: document.getElementsByTagName('a').length,
+            blocks: blocks, text: text};
+})()""" % {"max_blocks": MAX_BLOCKS, "text_buckets": TEXT_BUCKETS}
+
+def _off_by(returned, expected, total, tolerance):
+    # true if returned differs from expected by more than tolerance
+    # percent of total
+    return abs(returned - expected) * 100.0 / max(total, 1) > tolerance
+
+# the differences between two fingerprints that exceed tolerance
+# percent, as a list of messages; empty if they match. The height of
+# the page and of its last block are not compared, as content loaded
+# lazily at the bottom of a page makes them vary from load to load.
+def compare(expected, returned, tolerance):
+    diffs = []
+    if _off_by(returned["anchors"], expected["anchors"],
+               expected["anchors"], tolerance):
+        diffs.append("anchors=%d expected=%d"
+                     % (returned["anchors"], expected["anchors"]))
+    total = sum(expected["text"])
+    distance = sum(abs(r - e) for r, e in zip(returned["text"], expected["text"]))
+    if _off_by(distance, 0, total, tolerance):
+        diffs.append("text histogram differs by %d of %d nodes"
+                     % (distance, total))
+    if len(returned["blocks"]) != len(expected["blocks"]):
+        diffs.append("blocks=%d expected=%d"
+                     % (len(returned["blocks"]), len(expected["blocks"])))
+        return diffs
+    height = expected["height"] or 0
+    width = expected["width"] or 0
+    last = len(expected["blocks"]) - 1
+    for i, (r, e) in enumerate(zip(returned["blocks"], expected["blocks"])):
+        rtag, rleft, rtop, rwidth, rheight = r
+        etag, eleft, etop, ewidth, eheight = e
+        if rtag != etag:
+            diffs.append("block %d is <%s> expected <%s>" % (i, rtag, etag))
+        elif (_off_by(rleft, eleft, width, tolerance) or
+              _off_by(rwidth, ewidth, width, tolerance) or
+              _off_by(rtop, etop, height, tolerance) or
+              (i != last and _off_by(rheight, eheight, height, tolerance))):
+            diffs.append("block %d <%s> at %d,%d %dx%d expected %d,%d %dx%d"
+                         % (i, rtag, rleft, rtop, rwidth, rheight,
+                            eleft, etop, ewidth, eheight))
+    return diffs
@@ -0,0 +1,105 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Live counters and latency histograms of a worker, served over HTTP."""
+
+import socket
+import gobject
+from collections import defaultdict
+from logging import *
+from timing import BUCKETS
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+class Metrics:
+    # test results by test and status, and phase timings as cumulative
+    # histograms, kept in the Prometheus text format's terms. Recording
+    # is a couple of dict updates, rendering only happens when scraped.
+    def __init__(self):
+        self.results = defaultdict(int)
+        # phase -> [count per bucket of BUCKETS, then the open one]
+        self.buckets = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        self.sums = defaultdict(float)
+
+    def count(self, test, status):
+        self.results[(test, status)] += 1
+
+    def observe(self, phase, secs):
+        ms = secs * 1000
+        i = 0
+        while i < len(BUCKETS) and ms > BUCKETS[i]:
+            i += 1
+        self.buckets[phase][i] += 1
+        self.sums[phase] += secs
+
+    def render(self):
+        lines = ["# HELP regression_results_total Test results by outcome.",
+                 "# TYPE regression_results_total counter"]
+        for (test, status), n in sorted(self.results.items()):
+            lines.append('regression_results_total{test="%s",status="%s"} %d'
+                         % (test, status, n))
+        lines += ["# HELP regression_phase_seconds Time spent in each phase "
+                  "of a navigation or pause.",
+                  "# TYPE regression_phase_seconds histogram"]
+        for phase, counts in sorted(self.buckets.items()):
+            total = 0
+            for bound, n in zip(BUCKETS + ["+Inf"], counts):
+                total += n
+                le = bound if bound == "+Inf" else "%g" % (bound / 1000.0)
+                lines.append('regression_phase_seconds_bucket{phase="%s",'
+                             'le="%s"} %d' % (phase, le, total))
+            lines.append('regression_phase_seconds_sum{phase="%s"} %f'
+                         % (phase, self.sums[phase]))
+            lines.append('regression_phase_seconds_count{phase="%s"} %d'
+                         % (phase, total))
+        return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    # answers every HTTP request on 127.0.0.1:port with the rendered
+    # metrics. Requests are served from the GTK loop, so a scrape never
+    # races with the crawl updating the metrics.
+    def __init__(self, metrics, port):
+        self.metrics = metrics
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind(("127.0.0.1", port))
+        self.__sock.listen(5)
+        # client sockets waiting for their request to arrive
+        self.__clients = {}
+        self.__watch = gobject.io_add_watch(self.__sock, gobject.IO_IN,
+                                            self.__accept)
+        info("Serving metrics on http://127.0.0.1:%d/" % port)
+
+    def __accept(self, sock, condition):
+        try:
+            conn, addr = sock.accept()
+        except socket.error:
+            return True
+        self.__clients[conn.fileno()] = conn
+        gobject.io_add_watch(conn, gobject.IO_IN | gobject.IO_HUP,
+                             self.__respond)
+        return True
+
+    def __respond(self, conn, condition):
+        del self.__clients[conn.fileno()]
+        try:
+            # the request itself does not matter, every path gets the
+            # metrics
+            conn.recv(4096)
+            body = self.metrics.render()
+            conn.sendall("HTTP/1.0 200 OK\r\n"
+                         "Content-Type: %s\r\n"
+                         "Content-Length: %d\r\n\r\n%s"
+                         % (CONTENT_TYPE, len(body), body))
+        except socket.error as e:
+            warn("Failed to serve metrics: %s" % e)
+        conn.close()
+        return False
+
+    def close(self):
+        gobject.source_remove(self.__watch)
+        for conn in self.__clients.values():
+            conn.close()
+        self.__clients.clear()
+        self.__sock.close()
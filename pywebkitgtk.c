@@ -30,6 +30,7 @@
 #include <pygtk/pygtk.h>
 
 #include <webkit/webkit.h>
+#include <JavaScriptCore/JavaScript.h>
 
 // #include "pywebkit.h"
 typedef PyObject* (*ToPythonFn) (gpointer);
@@ -46,6 +47,12 @@ extern struct pyjoinapi pywebkit_api_fns;
 typedef struct {
     PyObject_HEAD
     WebKitWebView    *webview;
+    GtkWidget        *window;
+    /* GPatternSpecs of the uris of subresources not to load */
+    GPtrArray        *block_patterns;
+    /* domains, lowercased, whose hosts' subresources are not loaded */
+    GPtrArray        *block_hosts;
+    gulong           filter_handler;
 
 } WebViewObject;
 
@@ -58,6 +65,17 @@ destroy_cb (GtkWidget* widget, GtkWidget* window)
   gtk_main_quit ();
 }
 
+/* drops the reference a signal handler held on its python callback
+ * once the handler is disconnected, i.e. when the webview goes away */
+static void
+_py_callback_free (gpointer data, GClosure *closure)
+{
+    PyGILState_STATE __py_state;
+    __py_state = PyGILState_Ensure();
+    Py_XDECREF((PyObject*)data);
+    PyGILState_Release(__py_state);
+}
+
 
 static int
 WebView_init(WebViewObject *self, PyObject *args, PyObject *kwds)
@@ -65,7 +83,6 @@ WebView_init(WebViewObject *self, PyObject *args, PyObject *kwds)
     int width = 800;
     int height = 600;
     gchar *url = NULL;
-    GtkWidget* scrolled_window;
     GtkWidget *main_window;
 
     static char *kwlist[] = {"width", "height", "url", NULL};
@@ -75,6 +92,9 @@ WebView_init(WebViewObject *self, PyObject *args, PyObject *kwds)
         return -1;
 
     main_window = gtk_window_new (GTK_WINDOW_TOPLEVEL);
+    self->window = main_window;
+    self->block_patterns = g_ptr_array_new();
+    self->block_hosts = g_ptr_array_new();
     
     gtk_window_set_default_size (GTK_WINDOW (main_window), width, height);
     gtk_widget_set_name (main_window, "pywebkitgtk");
@@ -82,13 +102,8 @@ WebView_init(WebViewObject *self, PyObject *args, PyObject *kwds)
    
     self->webview = WEBKIT_WEB_VIEW (webkit_web_view_new ());
     
-    scrolled_window = gtk_scrolled_window_new (NULL, NULL);
-    gtk_scrolled_window_set_policy (GTK_SCROLLED_WINDOW (scrolled_window),
-                                    GTK_POLICY_AUTOMATIC, GTK_POLICY_AUTOMATIC);
-    //gtk_container_add (GTK_CONTAINER (scrolled_window),
-    //                  GTK_WIDGET (self->webview));
-    //gtk_container_add (GTK_CONTAINER (main_window),
-    //                  scrolled_window);
+    /* the webview is never shown, so it is not packed into a scrolled
+     * window, one created here would leak with every WebView */
     
     if (url)
       webkit_web_view_load_uri(self->webview, url);
@@ -148,6 +163,16 @@ static void _webview_docloaded_cb(WebKitWebFrame *view, GParamSpec* pspec,
     return;
 }
 
+/* like _webview_docloaded_cb, for the signals that pass the frame,
+ * but only for the main frame */
+static void _webview_main_frame_cb(WebKitWebView *view, WebKitWebFrame *frame,
+                                   gpointer data)
+{
+    if (frame != webkit_web_view_get_main_frame(view))
+        return;
+    _webview_docloaded_cb(frame, NULL, data);
+}
+
 static gboolean _webview_repaint_cb(GtkWidget* widget, GdkEventExpose *event,
 				    gpointer data)
 {
@@ -185,7 +210,8 @@ _webview_on_webview_doc_loaded(WebViewObject *self, PyObject* args)
     if (cb_fn)
         Py_INCREF(cb_fn);
 
-    g_signal_connect (self->webview, "load-finished", G_CALLBACK (_webview_docloaded_cb), (void*)cb_fn);
+    g_signal_connect_data (self->webview, "load-finished", G_CALLBACK (_webview_docloaded_cb),
+                           (void*)cb_fn, _py_callback_free, 0);
 
     Py_INCREF(Py_None);
     return Py_None;
@@ -204,7 +230,31 @@ _webview_on_webview_doc_loading(WebViewObject *self, PyObject* args)
     if (cb_fn)
         Py_INCREF(cb_fn);
 
-    g_signal_connect (self->webview, "load-started", G_CALLBACK (_webview_docloaded_cb), (void*)cb_fn);
+    g_signal_connect_data (self->webview, "load-started", G_CALLBACK (_webview_docloaded_cb),
+                           (void*)cb_fn, _py_callback_free, 0);
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject *
+_webview_on_webview_doc_committed(WebViewObject *self, PyObject* args)
+{
+    PyObject *cb_fn;
+    if (!PyArg_ParseTuple(args, "O", &cb_fn))
+        return NULL;
+
+    if (cb_fn == Py_None)
+        cb_fn = NULL;
+
+    if (cb_fn)
+        Py_INCREF(cb_fn);
+
+    /* the new document exists from here on, before any of it is
+     * parsed, including when it comes back from the page cache */
+    g_signal_connect_data (self->webview, "load-committed",
+                           G_CALLBACK (_webview_main_frame_cb),
+                           (void*)cb_fn, _py_callback_free, 0);
 
     Py_INCREF(Py_None);
     return Py_None;
@@ -223,8 +273,9 @@ _webview_on_webview_repaint(WebViewObject *self, PyObject* args)
     if (cb_fn)
         Py_INCREF(cb_fn);
 
-    g_signal_connect (self->webview, "expose-event", 
-		      G_CALLBACK (_webview_repaint_cb), (void *) cb_fn);
+    g_signal_connect_data (self->webview, "expose-event",
+			   G_CALLBACK (_webview_repaint_cb), (void *) cb_fn,
+			   _py_callback_free, 0);
 
 
     Py_INCREF(Py_None);
@@ -294,7 +345,8 @@ _console_message(WebViewObject *self, PyObject* args)
     if (cb_fn)
         Py_INCREF(cb_fn);
 
-    g_signal_connect (self->webview, "console-message", G_CALLBACK (_console_message_cb), (void*)cb_fn);
+    g_signal_connect_data (self->webview, "console-message", G_CALLBACK (_console_message_cb),
+                           (void*)cb_fn, _py_callback_free, 0);
 
     Py_INCREF(Py_None);
     return Py_None;
@@ -313,7 +365,8 @@ _script_alert(WebViewObject *self, PyObject* args)
     if (cb_fn)
         Py_INCREF(cb_fn);
 
-    g_signal_connect (self->webview, "script-alert", G_CALLBACK (_script_alert_cb), (void*)cb_fn);
+    g_signal_connect_data (self->webview, "script-alert", G_CALLBACK (_script_alert_cb),
+                           (void*)cb_fn, _py_callback_free, 0);
 
     Py_INCREF(Py_None);
     return Py_None;
@@ -330,6 +383,240 @@ _webview_ExecuteJs_Script(WebViewObject *self, PyObject* args)
     return Py_None;
 }
 
+static void
+_clear_block_patterns(WebViewObject *self)
+{
+    guint i;
+    for (i = 0; i < self->block_patterns->len; i++)
+        g_pattern_spec_free(g_ptr_array_index(self->block_patterns, i));
+    g_ptr_array_set_size(self->block_patterns, 0);
+    for (i = 0; i < self->block_hosts->len; i++)
+        g_free(g_ptr_array_index(self->block_hosts, i));
+    g_ptr_array_set_size(self->block_hosts, 0);
+}
+
+/* the host of uri, lowercased, or NULL if it has none; g_free it */
+static gchar *
+_uri_host(const gchar *uri)
+{
+    const gchar *start = strstr(uri, "://");
+    const gchar *end;
+    const gchar *c;
+
+    if (!start)
+        return NULL;
+    start += 3;
+    end = start + strcspn(start, "/?#");
+    for (c = start; c < end; c++)
+        if (*c == '@')
+            start = c + 1;
+    for (c = start; c < end; c++)
+        if (*c == ':') {
+            end = c;
+            break;
+        }
+    return g_ascii_strdown(start, end - start);
+}
+
+/* whether host is domain or one of its subdomains */
+static gboolean
+_host_in_domain(const gchar *host, const gchar *domain)
+{
+    size_t host_length = strlen(host);
+    size_t domain_length = strlen(domain);
+
+    if (host_length < domain_length ||
+        strcmp(host + host_length - domain_length, domain) != 0)
+        return FALSE;
+    return host_length == domain_length ||
+           host[host_length - domain_length - 1] == '.';
+}
+
+static void
+_resource_request_starting_cb(WebKitWebView *view, WebKitWebFrame *frame,
+                              WebKitWebResource *resource,
+                              WebKitNetworkRequest *request,
+                              WebKitNetworkResponse *response,
+                              gpointer data)
+{
+    WebViewObject *self = (WebViewObject*)data;
+    WebKitWebDataSource *source;
+    const gchar *uri = webkit_network_request_get_uri(request);
+    guint length;
+    guint i;
+
+    /* never block the document a frame is loading */
+    source = webkit_web_frame_get_provisional_data_source(frame);
+    if (source && webkit_web_data_source_get_main_resource(source) == resource)
+        return;
+
+    length = strlen(uri);
+    for (i = 0; i < self->block_patterns->len; i++) {
+        if (g_pattern_match(g_ptr_array_index(self->block_patterns, i),
+                            length, uri, NULL)) {
+            webkit_network_request_set_uri(request, "about:blank");
+            return;
+        }
+    }
+    if (self->block_hosts->len) {
+        gchar *host = _uri_host(uri);
+        gboolean blocked = FALSE;
+        for (i = 0; host && !blocked && i < self->block_hosts->len; i++)
+            blocked = _host_in_domain(host,
+                                      g_ptr_array_index(self->block_hosts, i));
+        g_free(host);
+        if (blocked)
+            webkit_network_request_set_uri(request, "about:blank");
+    }
+}
+
+// subresources whose uri matches one of the glob patterns in the
+// given sequence are not loaded, nor, for a pattern "||domain", those
+// on domain or any of its subdomains; an empty sequence loads
+// everything
+static PyObject *
+_webview_set_resource_filter(WebViewObject *self, PyObject* args)
+{
+    PyObject *patterns;
+    PyObject *seq;
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTuple(args, "O", &patterns))
+        return NULL;
+    seq = PySequence_Fast(patterns, "patterns must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    for (i = 0; i < PySequence_Fast_GET_SIZE(seq); i++) {
+        if (!PyString_Check(PySequence_Fast_GET_ITEM(seq, i))) {
+            PyErr_SetString(PyExc_TypeError, "patterns must be strings");
+            Py_DECREF(seq);
+            return NULL;
+        }
+    }
+
+    _clear_block_patterns(self);
+    for (i = 0; i < PySequence_Fast_GET_SIZE(seq); i++) {
+        gchar *pattern = PyString_AsString(PySequence_Fast_GET_ITEM(seq, i));
+        if (g_str_has_prefix(pattern, "||"))
+            g_ptr_array_add(self->block_hosts,
+                            g_ascii_strdown(pattern + 2, -1));
+        else
+            g_ptr_array_add(self->block_patterns, g_pattern_spec_new(pattern));
+    }
+    Py_DECREF(seq);
+
+    if (!self->filter_handler)
+        self->filter_handler = g_signal_connect (self->webview,
+                "resource-request-starting",
+                G_CALLBACK (_resource_request_starting_cb), (void*)self);
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+// free the webview and its window, and the python callbacks they hold
+static void
+_webview_destroy_widgets(WebViewObject *self)
+{
+    if (self->webview) {
+        /* the webview was never packed into the window, so it is
+         * still floating and nothing else owns it */
+        g_object_ref_sink(self->webview);
+        gtk_widget_destroy(GTK_WIDGET(self->webview));
+        g_object_unref(self->webview);
+        self->webview = NULL;
+        self->filter_handler = 0;
+    }
+    if (self->block_patterns) {
+        _clear_block_patterns(self);
+        g_ptr_array_free(self->block_patterns, TRUE);
+        g_ptr_array_free(self->block_hosts, TRUE);
+        self->block_patterns = NULL;
+        self->block_hosts = NULL;
+    }
+    if (self->window) {
+        g_signal_handlers_disconnect_by_func(self->window,
+                                             G_CALLBACK (destroy_cb), NULL);
+        gtk_widget_destroy(self->window);
+        self->window = NULL;
+    }
+}
+
+static PyObject *
+_webview_destroy(WebViewObject *self, PyObject* unused)
+{
+    _webview_destroy_widgets(self);
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static void
+WebView_dealloc(WebViewObject *self)
+{
+    _webview_destroy_widgets(self);
+    self->ob_type->tp_free((PyObject*)self);
+}
+
+static PyObject *
+_js_string_to_python(JSStringRef string)
+{
+    size_t size = JSStringGetMaximumUTF8CStringSize(string);
+    gchar *buffer = g_malloc(size);
+    PyObject *result;
+
+    JSStringGetUTF8CString(string, buffer, size);
+    result = PyString_FromString(buffer);
+    g_free(buffer);
+    return result;
+}
+
+// evaluate Java script code in the main frame and return its value
+// serialized as JSON, or None if the value has no JSON representation
+static PyObject *
+_webview_evaluate_js(WebViewObject *self, PyObject* args)
+{
+    gchar *script = NULL;
+    WebKitWebFrame *frame;
+    JSGlobalContextRef context;
+    JSStringRef js_script;
+    JSStringRef json = NULL;
+    JSValueRef value;
+    JSValueRef exception = NULL;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "s", &script))
+        return NULL;
+
+    frame = webkit_web_view_get_main_frame(self->webview);
+    context = webkit_web_frame_get_global_context(frame);
+    js_script = JSStringCreateWithUTF8CString(script);
+    value = JSEvaluateScript(context, js_script, NULL, NULL, 0, &exception);
+    JSStringRelease(js_script);
+    if (value && !exception)
+        json = JSValueCreateJSONString(context, value, 0, &exception);
+
+    if (exception) {
+        JSStringRef message = JSValueToStringCopy(context, exception, NULL);
+        PyObject *py_message = message ? _js_string_to_python(message) : NULL;
+        if (message)
+            JSStringRelease(message);
+        if (json)
+            JSStringRelease(json);
+        PyErr_SetString(PyExc_RuntimeError,
+                        py_message ? PyString_AsString(py_message) :
+                        "javascript exception");
+        Py_XDECREF(py_message);
+        return NULL;
+    }
+    if (!json) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    result = _js_string_to_python(json);
+    JSStringRelease(json);
+    return result;
+}
+
 static PyMethodDef WebView_methods[] = {
     {"LoadDocument", (PyCFunction)_webview_load_document,
                 METH_VARARGS,
@@ -351,6 +638,10 @@ static PyMethodDef WebView_methods[] = {
      (PyCFunction)_webview_on_webview_doc_loading,
      METH_VARARGS,
      PyDoc_STR("Sets Document callback function (load started)")},
+    {"SetDocumentCommittedCallback",
+     (PyCFunction)_webview_on_webview_doc_committed,
+     METH_VARARGS,
+     PyDoc_STR("Sets Document callback function (new document committed)")},
     {"SetRepaintCallback",
      (PyCFunction)_webview_on_webview_repaint,
      METH_VARARGS,
@@ -367,6 +658,18 @@ static PyMethodDef WebView_methods[] = {
      (PyCFunction)_webview_ExecuteJs_Script,
             METH_VARARGS,
      PyDoc_STR("Triggers mouse click event")},
+    {"EvaluateJs",
+     (PyCFunction)_webview_evaluate_js,
+            METH_VARARGS,
+     PyDoc_STR("Evaluates a script and returns its value as JSON")},
+    {"SetResourceFilter",
+     (PyCFunction)_webview_set_resource_filter,
+            METH_VARARGS,
+     PyDoc_STR("Sets glob patterns of subresource uris not to load")},
+    {"Destroy",
+     (PyCFunction)_webview_destroy,
+            METH_NOARGS,
+     PyDoc_STR("Frees the WebView, it cannot be used afterwards")},
     {NULL,  NULL, NULL, NULL},
 };
 
@@ -393,7 +696,7 @@ static PyTypeObject WebViewObjectType = {
     "pywebkitgtk.WebView",            /* tp_name           */
     sizeof(WebViewObject),     /* tp_basicsize      */
     0,              /* tp_itemsize       */
-    0,              /* tp_dealloc        */
+    (destructor)WebView_dealloc, /* tp_dealloc  */
     0,              /* tp_print          */
     0,              /* tp_getattr        */
     0,              /* tp_setattr        */
@@ -11,16 +11,58 @@ import time
 import os
 import argparse
 import uuid
+import hashlib
 import logging
 import browser
+import results
+import timing
+import layout
+import subprocess
+import threading
+import Queue
+import select
+import signal
+import gobject
+import urlparse
 from collections import deque
+from multiprocessing.managers import BaseManager
 from logging import *
-from browser import Browser
+from browser import Browser, BrowserPool, BLOCKABLE_RESOURCES, resource_patterns
+from baselinecache import BaselineCache
+from results import ResultStore
+from timing import PhaseTimer
+from sessions import SessionRecorder, ReplaySession, load_sessions
+from sessions import trace_key, trace_index
+from scheduler import Scheduler
+from checkpoint import Checkpoint, read_checkpoint, tested_urls
+from signatures import SignatureStore
+from metrics import Metrics, MetricsServer
+from visited import VisitedIndex
 import re
 
 workq = deque()
+baseline_cache = None
+# signatures of pages that passed, in --incremental mode
+signature_store = None
+# urls tested in the run, by this worker or any other
+visited_index = None
+result_store = None
+timer = PhaseTimer()
+# unproxied url no_proxy_br was told to load by start_baseline
+pending_baseline = None
+recorder = None
+# the recorded sessions, in --replay mode
+replay_traces = None
+# the session being replayed
+replay_session = None
+checkpoint = None
 
-def parse_args():
+class SeedQueueManager(BaseManager):
+    """Serves the coordinator's seed queue and visited url index to worker
+    processes."""
+    pass
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description=__doc__.strip(),
             formatter_class=argparse.ArgumentDefaultsHelpFormatter,
             add_help=False)
@@ -36,6 +78,9 @@ def parse_args():
             help="Maximum # of secs to wait for page load")
     parser.add_argument("-c", "--css-loadtime", type=float, default=1.5,
             help="Maximum # of secs to wait for css to load")
+    parser.add_argument("-a", "--adaptive-settle", action='store_true', default=False,
+            help="Stop waiting for css once the page size stops changing, "
+                 "up to --css-loadtime")
     parser.add_argument("-u", "--url-file", default="sites.txt",
             help="List of URLs from to explore")
     parser.add_argument("-p", "--proxy", default=None,
@@ -46,72 +91,317 @@ def parse_args():
             help="log directory for logs")
     parser.add_argument("-e", "--error-tolerance", default=10,
             help="page size error tolerance limit")
+    parser.add_argument("--layout-check", choices=["height", "fingerprint"],
+            default="height",
+            help="Compare only the page height against the unproxied page, "
+                 "or a fingerprint of its layout")
+    parser.add_argument("--incremental", action='store_true', default=False,
+            help="Skip testing pages that have not changed since they "
+                 "last passed, and the links of such pages that passed "
+                 "too (signatures are kept in page-signatures in the log "
+                 "directory)")
+    parser.add_argument("--incremental-max-age", type=float, default=7*86400,
+            help="# secs after which a page is tested in full again even "
+                 "if it has not changed")
     parser.add_argument("-v", "--verbose-output", action='store_true', default=False,
             help="show javascript console messages in logs")
-    args = parser.parse_args()
+    parser.add_argument("-b", "--baseline-cache", default=None,
+            help="File to keep unproxied page sizes in between runs "
+                 "(default: baseline-cache in the log directory)")
+    parser.add_argument("--baseline-ttl", type=float, default=86400,
+            help="# secs a cached unproxied page size stays valid "
+                 "(0 disables the cache)")
+    parser.add_argument("--baseline-cache-size", type=int, default=10000,
+            help="Maximum # of unproxied page sizes to cache")
+    parser.add_argument("-r", "--results-db", default=None,
+            help="SQLite database to record test results in "
+                 "(default: results.db in the log directory)")
+    parser.add_argument("--recycle-after", type=int, default=500,
+            help="# of page loads after which a browser's WebView is "
+                 "replaced (0 never replaces it)")
+    parser.add_argument("--max-rss", type=int, default=0,
+            help="Replace all WebViews once the worker has grown by "
+                 "more than this many MB since they were last replaced "
+                 "(0 disables the check)")
+    parser.add_argument("-B", "--block", default="",
+            help="Comma separated kinds of resources not to load, out of "
+                 + ", ".join(sorted(BLOCKABLE_RESOURCES)) + ". Pages "
+                 "without their images may be shorter, which the page "
+                 "size test then does not see")
+    parser.add_argument("--block-pattern", action="append", default=[],
+            help="Glob pattern of resource urls not to load, or "
+                 "||domain for every resource on domain and its "
+                 "subdomains (repeatable)")
+    parser.add_argument("--record", default=None,
+            help="File to append a trace of every crawl session to")
+    parser.add_argument("--replay", default=None,
+            help="Replay the sessions traced in this file instead of "
+                 "crawling the URL file")
+    parser.add_argument("--think-scale", type=float, default=1.0,
+            help="Factor to scale pauses between page visits by "
+                 "(0 removes them)")
+    parser.add_argument("-s", "--sessions", type=int, default=1,
+            help="# of seeds each worker crawls at a time, each with its "
+                 "own browsers, one progressing while the others pause")
+    parser.add_argument("--host-interval", type=float, default=0,
+            help="Minimum # of secs between page visits to the same host")
+    parser.add_argument("--run-id", default=None,
+            help="ID to record the results and progress of the run under "
+                 "(default: a new unique one)")
+    parser.add_argument("--resume", action='store_true', default=False,
+            help="Continue the run with this --run-id where it stopped, "
+                 "skipping the seeds and links it has tested already")
+    parser.add_argument("--hard-timeout", type=float, default=0,
+            help="Crawl in a child process, and kill and restart it when "
+                 "it shows no sign of life for this many secs, say 120 "
+                 "(0, the default, crawls in the worker process itself)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+            help="Serve live metrics of the worker in the Prometheus text "
+                 "format on this local port, the n-th of several workers "
+                 "on the n-th port from it (0 disables them)")
+    parser.add_argument("--visited-capacity", type=int, default=1000000,
+            help="# of urls the index of links tested in the run is sized "
+                 "for; links in it are not clicked again (0 clicks links "
+                 "every time they are found). It is rebuilt from the "
+                 "checkpoint on --resume and on restarts after "
+                 "--hard-timeout")
+    parser.add_argument("--visited-error", type=float, default=0.001,
+            help="Probability of an untested link being taken as tested "
+                 "once the index holds --visited-capacity urls")
+    parser.add_argument("-n", "--workers", type=int, default=1,
+            help="Number of worker processes to spawn")
+    # set by the coordinator on the worker processes it spawns
+    parser.add_argument("--coordinator", default=None,
+            help=argparse.SUPPRESS)
+    # set by a worker on the child process it crawls in
+    parser.add_argument("--supervised", action='store_true', default=False,
+            help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.resume and not args.run_id:
+        parser.error("--resume needs the --run-id of the run to resume")
+    args.block = [kind for kind in args.block.split(",") if kind]
+    for kind in args.block:
+        if kind not in BLOCKABLE_RESOURCES:
+            parser.error("unknown kind of resource to block: %s" % kind)
     return args
 
+def strip_proxy(url):
+    return re.sub(args.proxy+'/', '', url)
+
+def record(test, url, status, **kwargs):
+    result_store.record(test, url, status, **kwargs)
+    if recorder:
+        recorder.record(test, strip_proxy(url), status)
+
+# how long to pause between page visits like a user reading the page
+# would. do_browse_work yields it to the scheduler rather than sleeping,
+# so that other crawls of the worker progress in the meantime, together
+# with the url the visit after the pause loads.
+def think(url):
+    if replay_session:
+        pause = replay_session.next_think()
+    else:
+        pause = max(random.normalvariate(args.wait_time, 0.5), 0)
+    pause *= args.think_scale
+    timer.record(url, timing.THINK, pause)
+    if recorder:
+        recorder.think(pause)
+    return pause
+
 def do_click_test(urlItem):
     info("Click Test Started")
     info("Clicking on:"+urlItem)
     oldUrl = br.getUrl()
     br.JsMouseClickEvent(urlItem, timeout=args.timeout)
+    record(results.CLICK, urlItem, results.PASS)
+    start = time.time()
     br.gtk_sleep(1000)
+    timer.record(urlItem, timing.POST_CLICK, time.time() - start)
     info("Click Test Done")
 
+# start loading the unproxied version of url in no_proxy_br, so that
+# it loads while br loads the proxied page. do_page_size_test picks it
+# up from there.
+def start_baseline(url):
+    global pending_baseline
+    pending_baseline = None
+    no_proxy_url = strip_proxy(url)
+    if cached_baseline(no_proxy_url):
+        return
+    if signature_store and signature_store.get(no_proxy_url):
+        # the page likely has not changed, so its page size test will be
+        # skipped. do_page_size_test loads it if it has.
+        return
+    no_proxy_br.start_visit(no_proxy_url, timeout=args.timeout)
+    pending_baseline = no_proxy_url
+
+# what, besides the url, the baseline sizes of pages depend on, so that
+# those measured with other settings are not compared against
+def baseline_variant():
+    patterns = resource_patterns(args.block, args.block_pattern)
+    if not patterns:
+        return ""
+    return "block=" + hashlib.md5("\n".join(sorted(patterns))).hexdigest()[:12]
+
+# the cached baseline of no_proxy_url, if it has what --layout-check
+# compares
+def cached_baseline(no_proxy_url):
+    baseline = baseline_cache and baseline_cache.get(no_proxy_url)
+    if baseline and (args.layout_check == "height" or baseline.get("fingerprint")):
+        return baseline
+    return None
+
+# returns the status of the test, None if the page could not be tested
 def do_page_size_test(urlItem):
+    global pending_baseline
+    status = None
     returnedPageHeight = br.getDocumentHeight()
     if returnedPageHeight:
         info("Page Size Test Started")
-        no_proxy_url = urlItem
-        no_proxy_url =re.sub(args.proxy+'/', '', no_proxy_url)
-        no_proxy_br.visit(no_proxy_url, timeout=args.timeout)
-        no_proxy_br.gtk_sleep(1000)
-        expectedPageHeight = no_proxy_br.getDocumentHeight()
+        no_proxy_url = strip_proxy(urlItem)
+        baseline = cached_baseline(no_proxy_url)
+        if not baseline:
+            if pending_baseline != no_proxy_url:
+                no_proxy_br.start_visit(no_proxy_url, timeout=args.timeout)
+            pending_baseline = None
+            no_proxy_br.wait_visit(timeout=args.timeout)
+            no_proxy_br.settle((args.css_loadtime+1)*1000, timing.PAGE_SIZE_WAIT)
+            baseline = {"height": no_proxy_br.getDocumentHeight()}
+            if args.layout_check == "fingerprint":
+                baseline["fingerprint"] = no_proxy_br.getLayoutFingerprint()
+            if baseline["height"] and baseline_cache:
+                baseline_cache.put(no_proxy_url, baseline["height"],
+                                   no_proxy_br.getDocumentWidth(),
+                                   baseline.get("fingerprint"))
+        expectedPageHeight = baseline["height"]
         info("Page size: "+urlItem+"::"+"returnedPageHeight="+
                     str(returnedPageHeight)+"::"+"expectedPageHeight="+str(expectedPageHeight))
-        if expectedPageHeight:
+        if args.layout_check == "fingerprint":
+            status = do_layout_check(urlItem, baseline.get("fingerprint"),
+                                     returnedPageHeight, expectedPageHeight)
+        elif expectedPageHeight:
+            status = results.PASS
             errorvalue = (abs(returnedPageHeight-expectedPageHeight) *100)/expectedPageHeight
             if int(errorvalue) > int(args.error_tolerance):
+                status = results.FAIL
                 error("page size error::"+urlItem+"::"+"returnedPageHeight="+
                     str(returnedPageHeight)+"::"+"expectedPageHeight="+str(expectedPageHeight))
+            record(results.PAGE_SIZE, urlItem, status,
+                   returned=returnedPageHeight, expected=expectedPageHeight)
         info("Page Size Test Done")
+    return status
+
+def do_layout_check(urlItem, expected, returnedPageHeight, expectedPageHeight):
+    returned = br.getLayoutFingerprint()
+    if not (expected and returned):
+        missing = "baseline" if not expected else "page"
+        warn("No layout fingerprint of the %s of %s" % (missing, urlItem))
+        record(results.PAGE_SIZE, urlItem, results.SKIPPED,
+               returned=returnedPageHeight, expected=expectedPageHeight,
+               message="no fingerprint of the " + missing)
+        return None
+    diffs = layout.compare(expected, returned, float(args.error_tolerance))
+    status = results.PASS
+    if diffs:
+        status = results.FAIL
+        error("layout error::"+urlItem+"::"+"; ".join(diffs))
+    record(results.PAGE_SIZE, urlItem, status,
+           returned=returnedPageHeight, expected=expectedPageHeight,
+           message="; ".join(diffs) or None)
+    return status
+
+# the page size test, unless in --incremental mode the page has not
+# changed since it last passed. Returns whether it had not, and the
+# signature to remember for the page if the rest of its tests pass too.
+def do_changed_page_size_test(urlItem):
+    if not signature_store:
+        do_page_size_test(urlItem)
+        return False, None
+    signature = br.getPageSignature()
+    if signature_store.unchanged(strip_proxy(urlItem), signature):
+        info("Page unchanged: "+urlItem)
+        record(results.PAGE_SIZE, urlItem, results.UNCHANGED)
+        return True, None
+    if do_page_size_test(urlItem) != results.PASS:
+        return False, None
+    return False, (signature, br.getUrl())
+
+# in --incremental mode, remember the signature do_changed_page_size_test
+# returned for urlItem once all its tests are done, unless one of them
+# failed or timed out. Console errors and script alerts are recorded
+# against the url the page ended up at, so that is checked too.
+def remember_signature(urlItem, signature):
+    if not signature:
+        return
+    signature, page_url = signature
+    if urlItem in result_store.failed_urls or page_url in result_store.failed_urls:
+        return
+    signature_store.put(strip_proxy(urlItem), signature)
             
             
 def do_go_back_test():
     info("Going Back Test Started")
     oldUrl = br.getUrl()
     br.JsGoBack(timeout=args.timeout)
+    record(results.GO_BACK, oldUrl, results.PASS)
     info("Going Back Test Done")
     
-def do_browse_work(url):
+# key is what the seed was queued under, the seed itself unless replaying
+def do_browse_work(url, key=None):
+    key = key or url
     info("do browse work"+url)
     if args.proxy:
         target_url = "%s/"%(args.proxy) + url
+        if visited_index:
+            # so that links to it from other seeds are not clicked
+            visited_index.add(url)
+        start_baseline(target_url)
         try:
             br.visit(target_url, timeout=args.timeout)
         except browser.TimeoutException:
             warn("Timed out while visiting  %s"%(target_url))
+            record(results.VISIT, target_url, results.TIMEOUT)
             return
         else:
-            time.sleep(random.normalvariate(args.wait_time, 0.5))
+            record(results.VISIT, target_url, results.PASS)
+            yield think(target_url), target_url
             
         #test page size error for main page
+        unchanged, signature = False, None
         try:
-            do_page_size_test(target_url)
+            unchanged, signature = do_changed_page_size_test(target_url)
         except browser.TimeoutException:
             warn("Timed out while doing page size test on %s"%(target_url))
+            record(results.PAGE_SIZE, target_url, results.TIMEOUT)
 
         urlList = []
-        br.GetUrlList(urlList)
+        if replay_session:
+            # click the same links as the recorded session did
+            urlList = ["%s/"%(args.proxy) + clicked
+                       for clicked in replay_session.clicks]
+        else:
+            br.GetUrlList(urlList)
         #random.shuffle(urlList)
         info("urlcount: " +str(len(urlList)))
+        # the link whose page was last gone back from
+        last_read = None
         for urlItem in urlList:
             # only click on branch_factor 
             # number of urls on this page
             info("branch factor "+str(br.branch_factor))
             if br.branch_factor < 1:
                 break;
+            if strip_proxy(urlItem) in checkpoint.tested[key]:
+                # tested before the run was resumed
+                br.branch_factor -= 1
+                continue
+            if unchanged and signature_store.get(strip_proxy(urlItem)):
+                # the page it is on has not changed, and it passed last
+                # time it was tested
+                info("Link unchanged: "+urlItem)
+                record(results.CLICK, urlItem, results.UNCHANGED)
+                br.branch_factor -= 1
+                continue
             
             anchorElem = br.GetAnchorElement(urlItem)
             # this can happen when we come to this page after hitting go back
@@ -119,64 +409,447 @@ def do_browse_work(url):
             # exist
             if anchorElem < 0:
                 continue
+            if visited_index and visited_index.contains(strip_proxy(urlItem)):
+                # tested already, from this seed or another
+                info("Already tested: "+urlItem)
+                continue
+            # the click loads a page of another host, maybe
+            yield (think(last_read) if last_read else 0), urlItem
             # set the id attributes value so that later we can uniquely search it
             anchorElem.setAttribute('id',urlItem)
             
             #test mouse click
+            start_baseline(urlItem)
             try:
                 do_click_test(urlItem)
             except browser.TimeoutException:
                 warn("Timed out while clicking on %s"%(urlItem))
+                record(results.CLICK, urlItem, results.TIMEOUT)
+                link_tested(key, urlItem)
                 return
             else:
-                time.sleep(random.normalvariate(args.wait_time, 0.5))
+                if visited_index:
+                    visited_index.add(strip_proxy(urlItem))
+                yield think(urlItem), urlItem
             
             #test page size error
+            link_signature = None
             try:
-                do_page_size_test(urlItem)
+                link_signature = do_changed_page_size_test(urlItem)[1]
             except browser.TimeoutException:
                 warn("Timed out while doing page size test on %s"%(urlItem))
+                record(results.PAGE_SIZE, urlItem, results.TIMEOUT)
             else:
-                time.sleep(random.normalvariate(args.wait_time, 0.5))
+                yield think(urlItem), target_url
             
             #test go back
             try:
                 do_go_back_test()
             except browser.TimeoutException:
                 warn("Timed out while going from %s"%(br.getUrl()))
+                record(results.GO_BACK, br.getUrl(), results.TIMEOUT)
+                link_tested(key, urlItem)
                 return
             else:
-                time.sleep(random.normalvariate(args.wait_time, 0.5))
+                link_tested(key, urlItem)
+                remember_signature(urlItem, link_signature)
+                last_read = urlItem
             
             br.branch_factor -=1
+        remember_signature(target_url, signature)
 
-if __name__ == '__main__':
-    args = parse_args()
-    if args.id == None:
-        args.id = str(uuid.uuid4())[0:2]
+# checkpoint a tested link of seed, with its results saved first so
+# that a resumed run does not lose them
+def link_tested(seed, urlItem):
+    result_store.flush()
+    checkpoint.link_tested(seed, strip_proxy(urlItem))
+
+def read_seed_urls(url_file):
+    with open(url_file, "r") as f:
+        lines = f.readlines()
+    return ["http://" + line.strip() for line in lines if line.strip()]
+
+def checkpoint_file():
+    return os.path.join(args.log_dir, "checkpoint-"+args.run_id)
+
+def fill_visited_index(index):
+    for url in tested_urls(checkpoint_file()):
+        index.add(url)
+
+# the seed a key from the seed queue stands for
+def seed_url(key):
+    if replay_traces is not None:
+        return replay_traces[trace_index(key)]["seed"]
+    return key
+
+def read_seeds():
+    if args.replay:
+        seeds = [trace_key(n, trace)
+                 for n, trace in enumerate(load_sessions(args.replay))]
+    else:
+        seeds = read_seed_urls(args.url_file)
+    if not args.resume:
+        # a new run, forget the progress of an earlier one with this id
+        open(checkpoint_file(), "w").close()
+        return seeds
+    done = read_checkpoint(checkpoint_file())[0]
+    return [seed for seed in seeds if seed not in done]
 
-    logFileName = os.path.join(args.log_dir,"worker-"+args.id)
+# an id for a new run, unique across the runs sharing a results database
+# or log directory. The --id of a worker is only short enough to read in
+# its log lines.
+def new_run_id():
+    return time.strftime("%Y%m%d%H%M%S-") + uuid.uuid4().hex
+
+def init_logging(worker_id, filemode='w'):
+    logFileName = os.path.join(args.log_dir,"worker-"+worker_id)
     logging.basicConfig(level=logging.INFO,
-      format="[worker-%s] "%(args.id) + "%(levelname)s %(message)s",
+      format="[worker-%s] "%(worker_id) + "%(levelname)s %(message)s",
       filename=logFileName,
-      filemode='w')
-    
-    #will be used for visitng pages through cloudterminal
-    br = Browser(args.branch_factor,args.verbose_output,False,args.css_loadtime)
-    #will be used for visiting without cloudterminal
-    no_proxy_br = Browser(args.branch_factor,False,True,args.css_loadtime)
-    info("Worker started")
+      filemode=filemode)
+    return logFileName
 
-    # Read the URLS
-    with open(args.url_file, "r") as f:
-        lines = f.readlines()
-    for line in lines:
-        url = "http://" + line.strip()
-        workq.append(url)
+class Slot:
+    # a pair of browsers a worker crawls one seed at a time with. The
+    # test functions find the browsers and the state of the crawl in
+    # module globals, so a slot swaps its own in around every step.
+    STATE = ("br", "no_proxy_br", "pending_baseline", "replay_session",
+             "recorder")
+
+    def __init__(self, pool, br, no_proxy_br):
+        self.pool = pool
+        self.state = {"br": br, "no_proxy_br": no_proxy_br,
+                      "pending_baseline": None, "replay_session": None,
+                      "recorder": None}
+        if args.record:
+            self.state["recorder"] = SessionRecorder(args.record)
+
+    def step(self, steps):
+        g = globals()
+        for name in self.STATE:
+            g[name] = self.state[name]
+        try:
+            return next(steps)
+        finally:
+            for name in self.STATE:
+                self.state[name] = g[name]
+
+class Crawl:
+    # the crawl of one seed on a slot, run by the worker's scheduler. key
+    # is what the seed was queued under, host that of the page its next
+    # step loads.
+    def __init__(self, slot, key):
+        self.slot = slot
+        self.key = key
+        self.url = seed_url(key)
+        self.host = urlparse.urlparse(self.url).netloc
+        self.__steps = self.__run()
 
-    while len(workq):
-        url = workq.popleft()
+    def __run(self):
+        global replay_session
         br.branch_factor = args.branch_factor
-        do_browse_work(url)
-    
+        if replay_traces is not None:
+            replay_session = ReplaySession(replay_traces[trace_index(self.key)])
+            br.branch_factor = len(replay_session.clicks)
+        if recorder:
+            recorder.start(self.url)
+        for pause, url in do_browse_work(self.url, self.key):
+            self.host = urlparse.urlparse(strip_proxy(url)).netloc
+            yield pause
+        if recorder:
+            recorder.finish()
+        result_store.flush()
+        if baseline_cache:
+            baseline_cache.save()
+        if signature_store:
+            signature_store.save()
+        checkpoint.seed_done(self.key)
+        if args.supervised:
+            tell_watchdog("done " + self.key)
+
+    def step(self):
+        return self.slot.step(self.__steps)
+
+def run_worker(worker_id, next_seed):
+    global baseline_cache, signature_store, result_store, replay_traces
+    global checkpoint, visited_index
+    if args.supervised:
+        # the log of the watchdog, and of the children it ran before
+        init_logging(worker_id, 'a')
+        gobject.timeout_add(HEARTBEAT_MS, heartbeat)
+    else:
+        init_logging(worker_id)
+    if args.replay:
+        replay_traces = load_sessions(args.replay)
+    metrics_server = None
+    if args.metrics_port:
+        timer.metrics = Metrics()
+        metrics_server = MetricsServer(timer.metrics, args.metrics_port)
+    result_store = ResultStore(
+        args.results_db or os.path.join(args.log_dir, "results.db"),
+        args.run_id, worker_id, metrics=timer.metrics)
+    checkpoint = Checkpoint(checkpoint_file(), args.resume)
+    if args.baseline_ttl > 0:
+        baseline_cache = BaselineCache(
+            args.baseline_cache or os.path.join(args.log_dir, "baseline-cache"),
+            args.baseline_ttl,
+            args.baseline_cache_size, baseline_variant())
+    if args.visited_capacity and not args.replay:
+        # replays click the links their recording did, tested or not
+        if args.coordinator:
+            visited_index = connect_coordinator(args.coordinator).get_visited_index()
+        else:
+            visited_index = VisitedIndex(args.visited_capacity, args.visited_error)
+            if args.resume or args.supervised:
+                # what the run tested before this process started
+                fill_visited_index(visited_index)
+    if args.incremental:
+        signature_store = SignatureStore(
+            os.path.join(args.log_dir, "page-signatures"),
+            args.incremental_max_age, args.baseline_cache_size)
+
+    # both browsers skip the same resources, so that page sizes stay
+    # comparable
+    block_patterns = resource_patterns(args.block, args.block_pattern)
+    free_slots = []
+    for n in range(args.sessions):
+        pool = BrowserPool(args.recycle_after, args.max_rss)
+        #will be used for visitng pages through cloudterminal
+        proxy_br = pool.add(Browser(args.branch_factor,args.verbose_output,False,args.css_loadtime,
+                                    result_store, timer, args.adaptive_settle,
+                                    block_patterns))
+        #will be used for visiting without cloudterminal
+        baseline_br = pool.add(Browser(args.branch_factor,False,True,args.css_loadtime,
+                                       timer=timer, adaptive_settle=args.adaptive_settle,
+                                       block_patterns=block_patterns))
+        free_slots.append(Slot(pool, proxy_br, baseline_br))
+    slots = list(free_slots)
+    info("Worker started")
+
+    def start_crawl():
+        key = next_seed()
+        if key is None:
+            return None
+        slot = free_slots.pop()
+        slot.pool.maintain()
+        return Crawl(slot, key)
+
+    def finished(crawl):
+        free_slots.append(crawl.slot)
+
+    # idle in the GTK loop, so that the pages the browsers are loading
+    # keep loading
+    wait = lambda secs: slots[0].state["br"].gtk_sleep(secs*1000)
+    sched = Scheduler(wait, args.host_interval)
+    sched.run(start_crawl, finished, len(slots))
+
+    result_store.close()
+    checkpoint.close()
+    if metrics_server:
+        metrics_server.close()
+    for slot in slots:
+        if slot.state["recorder"]:
+            slot.state["recorder"].close()
+    for line in timer.report():
+        info(line)
     info("Worker terminating.")
+
+# a supervised worker tells the watchdog, one line at a time on stdout,
+#   "alive" every HEARTBEAT_MS while the GTK loop runs,
+#   "next" when it wants another seed, answered by a line on stdin with
+#          the seed or an empty one if there are no more,
+#   "done <seed>" once it has crawled a seed.
+HEARTBEAT_MS = 1000
+
+def tell_watchdog(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+def heartbeat():
+    tell_watchdog("alive")
+    return True
+
+def next_watchdog_seed():
+    tell_watchdog("next")
+    return sys.stdin.readline().strip() or None
+
+# runs the crawl in a child process and gives it the seeds from
+# next_seed. A child that dies, or that goes args.hard_timeout secs
+# without a sign of life (say WebKit blocked the GTK loop), is killed and
+# replaced, and the seeds it was crawling are recorded as timed out.
+def run_watchdog(worker_id, next_seed):
+    global replay_traces
+    # the children log to the same file, so truncate it once and have
+    # every process append; a handler opened with 'w' would write over
+    # their lines at its own offset
+    open(os.path.join(args.log_dir, "worker-"+worker_id), "w").close()
+    init_logging(worker_id, 'a')
+    if args.replay:
+        replay_traces = load_sessions(args.replay)
+    result_store = ResultStore(
+        args.results_db or os.path.join(args.log_dir, "results.db"),
+        args.run_id, worker_id)
+    cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + \
+            ["--id", worker_id, "--run-id", args.run_id,
+             "--supervised"]
+    exhausted = False
+    while True:
+        child = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+        info("Started crawler process %d" % child.pid)
+        in_flight = []
+        asked = False
+        pending = ""
+        lines = []
+        while True:
+            if not lines:
+                ready = select.select([child.stdout], [], [],
+                                      args.hard_timeout)[0]
+                if not ready:
+                    error("Crawler process %d hung, killing it" % child.pid)
+                    os.kill(child.pid, signal.SIGKILL)
+                    break
+                data = os.read(child.stdout.fileno(), 4096)
+                if not data:
+                    break
+                lines = (pending + data).split("\n")
+                pending = lines.pop()
+                continue
+            line = lines.pop(0)
+            if line == "next":
+                asked = True
+                key = None if exhausted else next_seed()
+                if key is None:
+                    exhausted = True
+                else:
+                    in_flight.append(key)
+                try:
+                    child.stdin.write((key or "") + "\n")
+                    child.stdin.flush()
+                except IOError:
+                    # it died, the read of its stdout will tell
+                    pass
+            elif line.startswith("done "):
+                in_flight.remove(line[len("done "):])
+        status = child.wait()
+        child.stdin.close()
+        child.stdout.close()
+        if status:
+            warn("Crawler process %d exited with %d" % (child.pid, status))
+        for key in in_flight:
+            url = seed_url(key)
+            target_url = "%s/"%(args.proxy) + url if args.proxy else url
+            warn("Lost %s with crawler process %d" % (target_url, child.pid))
+            result_store.record(results.VISIT, target_url, results.TIMEOUT,
+                                message="crawler process hung or died")
+        result_store.flush()
+        if exhausted:
+            break
+        if not asked:
+            # it died before crawling anything, a new one would too
+            error("Crawler process %d failed to start" % child.pid)
+            break
+    result_store.close()
+    info("Worker terminating.")
+
+def next_local_seed():
+    if len(workq):
+        return workq.popleft()
+    return None
+
+def connect_coordinator(address):
+    host, port = address.rsplit(":", 1)
+    SeedQueueManager.register("get_seed_queue")
+    SeedQueueManager.register("get_visited_index")
+    manager = SeedQueueManager(address=(host, int(port)),
+            authkey=os.environ["REGRESSION_AUTHKEY"])
+    manager.connect()
+    return manager
+
+def write_run_summary(worker_ids, exit_codes):
+    summaryFileName = os.path.join(args.log_dir, "run-"+args.run_id)
+    # the log also has the baseline browser's visits, the results only
+    # the proxied ones
+    visits = results.visits_by_worker(
+        args.results_db or os.path.join(args.log_dir, "results.db"),
+        args.run_id)
+    with open(summaryFileName, "w") as summary:
+        for worker_id in worker_ids:
+            logFileName = os.path.join(args.log_dir, "worker-"+worker_id)
+            try:
+                with open(logFileName, "r") as f:
+                    lines = f.readlines()
+            except IOError:
+                lines = []
+            warnings = len([l for l in lines if " WARNING " in l])
+            errors = len([l for l in lines if " ERROR " in l])
+            summary.write("worker-%s: exit=%s visits=%d warnings=%d errors=%d\n"
+                    % (worker_id, exit_codes[worker_id],
+                       visits.get(worker_id, 0), warnings, errors))
+        for worker_id in worker_ids:
+            logFileName = os.path.join(args.log_dir, "worker-"+worker_id)
+            if os.path.exists(logFileName):
+                with open(logFileName, "r") as f:
+                    summary.writelines(f.readlines())
+    return summaryFileName
+
+def run_coordinator():
+    # workers are separate interpreters rather than forks of this one so
+    # that none of them shares the GTK display connection opened when
+    # the browser module was imported
+    seedq = Queue.Queue()
+    for url in read_seeds():
+        seedq.put(url)
+    for n in range(args.workers):
+        seedq.put(None)
+
+    authkey = os.urandom(16).encode("hex")
+    SeedQueueManager.register("get_seed_queue", callable=lambda: seedq)
+    if args.visited_capacity:
+        visited = VisitedIndex(args.visited_capacity, args.visited_error)
+        if args.resume:
+            fill_visited_index(visited)
+        SeedQueueManager.register("get_visited_index", callable=lambda: visited)
+    manager = SeedQueueManager(address=("127.0.0.1", 0), authkey=authkey)
+    server = manager.get_server()
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    env = dict(os.environ, REGRESSION_AUTHKEY=authkey)
+    address = "%s:%d" % server.address
+    workers = {}
+    for n in range(args.workers):
+        worker_id = "%s-%d" % (args.id, n)
+        cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + \
+                ["--id", worker_id, "--run-id", args.run_id,
+                 "--coordinator", address]
+        if args.metrics_port:
+            cmd += ["--metrics-port", str(args.metrics_port + n)]
+        workers[worker_id] = subprocess.Popen(cmd, env=env)
+
+    exit_codes = {}
+    for worker_id, proc in workers.items():
+        exit_codes[worker_id] = proc.wait()
+    return write_run_summary(sorted(workers.keys()), exit_codes)
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.id == None:
+        args.id = str(uuid.uuid4())[0:2]
+    if args.run_id == None:
+        args.run_id = new_run_id()
+
+    run = run_worker
+    if args.hard_timeout > 0:
+        run = run_watchdog
+    if args.supervised:
+        run_worker(args.id, next_watchdog_seed)
+    elif args.coordinator:
+        seedq = connect_coordinator(args.coordinator).get_seed_queue()
+        run(args.id, seedq.get)
+    elif args.workers > 1:
+        run_coordinator()
+    else:
+        workq.extend(read_seeds())
+        run(args.id, next_local_seed)
@@ -0,0 +1,101 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Stores test results as rows of a SQLite database."""
+
+import sqlite3
+import time
+
+# test types
+VISIT = "visit"
+CLICK = "click"
+PAGE_SIZE = "page_size"
+GO_BACK = "go_back"
+CONSOLE_ERROR = "console_error"
+SCRIPT_ALERT = "script_alert"
+
+# outcomes
+PASS = "pass"
+FAIL = "fail"
+TIMEOUT = "timeout"
+# not tested, as the page has not changed since it last passed
+UNCHANGED = "unchanged"
+# not tested, as what the test compares could not be measured
+SKIPPED = "skipped"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    worker_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    test TEXT NOT NULL,
+    url TEXT,
+    status TEXT NOT NULL,
+    returned REAL,
+    expected REAL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS results_run_id ON results (run_id);
+CREATE INDEX IF NOT EXISTS results_url ON results (url);
+CREATE INDEX IF NOT EXISTS results_test ON results (test);
+"""
+
+class ResultStore:
+    # rows are buffered and written batch_size at a time in a single
+    # transaction, so recording a result costs no disk I/O. Results are
+    # counted in metrics too, if given.
+    def __init__(self, filename, run_id, worker_id, batch_size=100,
+                 metrics=None):
+        self.run_id = run_id
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.metrics = metrics
+        # urls that some test failed or timed out on
+        self.failed_urls = set()
+        self.__rows = []
+        # several workers share the database; with WAL they do not
+        # block each other and commits need not fsync
+        self.__db = sqlite3.connect(filename, timeout=60)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.executescript(SCHEMA)
+
+    def record(self, test, url, status, returned=None, expected=None,
+               message=None):
+        self.__rows.append((self.run_id, self.worker_id, time.time(), test,
+                            url, status, returned, expected, message))
+        if self.metrics:
+            self.metrics.count(test, status)
+        if status in (FAIL, TIMEOUT):
+            self.failed_urls.add(url)
+        if len(self.__rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.__rows:
+            return
+        with self.__db:
+            self.__db.executemany("INSERT INTO results (run_id, worker_id, "
+                    "ts, test, url, status, returned, expected, message) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self.__rows)
+        self.__rows = []
+
+    def close(self):
+        self.flush()
+        self.__db.close()
+
+# worker id -> # of seeds it visited through the proxy in run_id,
+# whether the visit passed or not
+def visits_by_worker(filename, run_id):
+    db = sqlite3.connect(filename, timeout=60)
+    try:
+        return dict(db.execute("SELECT worker_id, COUNT(*) FROM results "
+                "WHERE run_id = ? AND test = ? GROUP BY worker_id",
+                (run_id, VISIT)).fetchall())
+    except sqlite3.OperationalError:
+        # no worker got to create the table
+        return {}
+    finally:
+        db.close()
@@ -0,0 +1,68 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Interleaving of crawls around their pauses and per-host politeness."""
+
+import time
+import heapq
+import itertools
+
+class Scheduler:
+    # runs tasks, objects whose step() does some browsing and returns
+    # the # of secs to pause before the next step, or raises
+    # StopIteration once the task is done, and whose host is that of the
+    # page their next step loads. While a task pauses the others make
+    # progress, and a step on a host starts at least host_interval secs
+    # after the previous step on that host ended, whichever task it
+    # belonged to. wait(secs) is called to idle
+    # until the next step is due, it should keep the GTK loop running.
+    def __init__(self, wait, host_interval=0):
+        self.wait = wait
+        self.host_interval = host_interval
+        # (deadline, seq, task), seq keeps equal deadlines in FIFO order
+        # and tasks from being compared
+        self.__queue = []
+        self.__seq = itertools.count()
+        # host -> time its next step may start
+        self.__host_ready = {}
+
+    def __push(self, deadline, task):
+        heapq.heappush(self.__queue, (deadline, next(self.__seq), task))
+
+    # start_task() returns the next task to run, or None once
+    # there is no more work, finished(task) is called once a task is
+    # done. At most capacity tasks run at a time.
+    def run(self, start_task, finished, capacity=1):
+        active = 0
+        exhausted = False
+        while True:
+            while not exhausted and active < capacity:
+                task = start_task()
+                if task is None:
+                    exhausted = True
+                else:
+                    self.__push(time.time(), task)
+                    active += 1
+            if not self.__queue:
+                break
+            deadline, seq, task = heapq.heappop(self.__queue)
+            host = task.host
+            ready = self.__host_ready.get(host, 0)
+            if ready > deadline:
+                # its host is not ready yet, some other task may be due
+                # before it is
+                self.__push(ready, task)
+                continue
+            remaining = deadline - time.time()
+            if remaining > 0:
+                self.wait(remaining)
+            try:
+                pause = task.step()
+            except StopIteration:
+                active -= 1
+                finished(task)
+                continue
+            finally:
+                self.__host_ready[host] = time.time() + self.host_interval
+            self.__push(time.time() + pause, task)
@@ -0,0 +1,74 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Recording and replaying of crawl sessions."""
+
+import json
+import time
+from collections import deque
+import results
+
+class SessionRecorder:
+    # appends every finished session to filename as one line of JSON:
+    #   {"seed": url, "started": time,
+    #    "events": [[secs, test, url, status], ...],
+    #    "thinks": [secs, ...]}
+    # event times count from the start of the session, urls are stored
+    # without the proxy prefix
+    def __init__(self, filename):
+        self.__file = open(filename, "a")
+        self.__session = None
+
+    def start(self, seed):
+        self.__session = {"seed": seed, "started": time.time(),
+                          "events": [], "thinks": []}
+
+    def record(self, test, url, status):
+        if self.__session:
+            offset = round(time.time() - self.__session["started"], 3)
+            self.__session["events"].append([offset, test, url, status])
+
+    def think(self, secs):
+        if self.__session:
+            self.__session["thinks"].append(round(secs, 3))
+
+    def finish(self):
+        if self.__session:
+            # a single write, so sessions of workers sharing the file
+            # do not interleave
+            self.__file.write(json.dumps(self.__session,
+                                         separators=(",", ":")) + "\n")
+            self.__file.flush()
+            self.__session = None
+
+    def close(self):
+        self.finish()
+        self.__file.close()
+
+class ReplaySession:
+    def __init__(self, trace):
+        self.seed = trace["seed"]
+        # the links clicked, in the order they were clicked
+        self.clicks = [url for offset, test, url, status in trace["events"]
+                       if test == results.CLICK]
+        self.thinks = deque(trace["thinks"])
+
+    # the next recorded think time, 0 once they have run out
+    def next_think(self):
+        if self.thinks:
+            return self.thinks.popleft()
+        return 0.0
+
+# the key a recorded session is queued under in place of its seed: its
+# line in the trace file and its seed, so that every recording of a seed
+# is replayed once, by whichever worker gets it
+def trace_key(n, trace):
+    return "%d %s" % (n, trace["seed"])
+
+def trace_index(key):
+    return int(key.split(" ", 1)[0])
+
+def load_sessions(filename):
+    with open(filename, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,55 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Signatures of page content, for re-testing only pages that changed."""
+
+from baselinecache import UrlCache
+
+# evaluates to a hash of the tags and text of the page, as a hex
+# string. Scripts, styles and whitespace are left out, so that only
+# what the user sees changes it.
+SIGNATURE_JS = """(function() {
+    if (!document.body)
+        return null;
+    var hash = 0x811c9dc5;
+    function add(s) {
+        for (var i = 0; i < s.length; i++) {
+            hash ^= s.charCodeAt(i);
+            // hash * 0x01000193 mod 2^32; the product itself is past
+            // the 53 bits a number holds exactly, and the WebKit this
+            // runs in predates Math.imul
+            hash = (hash + (hash << 1) + (hash << 4) + (hash << 7) +
+                    (hash << 8) + (hash << 24)) >>> 0;
+        }
+    }
+    var walker = document.createTreeWalker(document.body,
+        NodeFilter.SHOW_ELEMENT | NodeFilter.SHOW_TEXT, {
+            acceptNode: function(node) {
+                var tag = node.nodeType == 1 ? node : node.parentNode;
+                return /^(SCRIPT|STYLE|NOSCRIPT)$/.test(tag.tagName) ?
+                    NodeFilter.FILTER_REJECT : NodeFilter.FILTER_ACCEPT;
+            }
+        }, false);
+    var node;
+    while ((node = walker.nextNode())) {
+        if (node.nodeType == 1)
+            add("<" + node.tagName);
+        else
+            add(node.nodeValue.replace(/\\s+/g, " ").trim());
+    }
+    return hash.toString(16);
+})()"""
+
+class SignatureStore(UrlCache):
+    # the signature of every page that passed its tests, keyed by its
+    # unproxied url. Entries older than ttl are dropped, so that pages
+    # skipped because nothing seemed to change are re-tested in full
+    # now and then.
+    def put(self, url, signature):
+        self._put(url, {"signature": signature})
+
+    # true if url passed its tests when its content had this signature
+    def unchanged(self, url, signature):
+        entry = self.get(url)
+        return bool(signature and entry and entry["signature"] == signature)
@@ -0,0 +1,76 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Per-phase timing of page loads and harness pauses."""
+
+import math
+from collections import defaultdict
+
+# phases of a navigation, timed from when the request was issued
+DOM_READY = "dom_ready"
+LOADER_GONE = "loader_gone"
+TITLE_LOADED = "title_loaded"
+LOADED = "loaded"
+# pauses, timed by how long they took
+CSS_SETTLE = "css_settle"
+PAGE_SIZE_WAIT = "page_size_wait"
+POST_CLICK = "post_click"
+THINK = "think"
+
+# upper bounds (ms) of the histogram buckets, the last one is open
+BUCKETS = [50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+def percentile(values, p):
+    # nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def histogram(values):
+    counts = [0] * (len(BUCKETS) + 1)
+    for value in values:
+        ms = value * 1000
+        i = 0
+        while i < len(BUCKETS) and ms >= BUCKETS[i]:
+            i += 1
+        counts[i] += 1
+    return counts
+
+class PhaseTimer:
+    # timings are also observed by metrics, if set
+    def __init__(self, metrics=None):
+        # phase -> url -> [secs]
+        self.samples = defaultdict(lambda: defaultdict(list))
+        self.metrics = metrics
+
+    def record(self, url, phase, secs):
+        self.samples[phase][url].append(secs)
+        if self.metrics:
+            self.metrics.observe(phase, secs)
+
+    def summary(self):
+        # phase -> (count, p50, p95, p99, max) over all urls, in secs
+        result = {}
+        for phase, by_url in self.samples.items():
+            values = sorted(v for secs in by_url.values() for v in secs)
+            result[phase] = (len(values), percentile(values, 50),
+                             percentile(values, 95), percentile(values, 99),
+                             values[-1])
+        return result
+
+    def report(self):
+        lines = []
+        labels = ["<%dms" % b for b in BUCKETS] + [">=%dms" % BUCKETS[-1]]
+        for phase, (n, p50, p95, p99, top) in sorted(self.summary().items()):
+            lines.append("timing %s: n=%d p50=%.0fms p95=%.0fms p99=%.0fms "
+                         "max=%.0fms" % (phase, n, p50*1000, p95*1000,
+                                         p99*1000, top*1000))
+        for phase, by_url in sorted(self.samples.items()):
+            for url, secs in sorted(by_url.items()):
+                counts = histogram(secs)
+                lines.append("timing %s %s: %s" % (phase, url, " ".join(
+                    "%s=%d" % (label, c)
+                    for label, c in zip(labels, counts) if c)))
+        return lines
@@ -0,0 +1,79 @@
+#
+# vim:ts=4:sw=4:expandtab
+######################################################################
+
+"""Run-wide index of the urls tested already."""
+
+import math
+import struct
+import hashlib
+import threading
+import urllib
+import urlparse
+from baselinecache import normalize_url
+
+# query parameters that only tell where a visitor came from
+TRACKING_PARAMS = set(["gclid", "fbclid", "msclkid", "yclid", "dclid",
+                       "mc_cid", "mc_eid", "_ga", "_gl"])
+
+def canonical_url(url):
+    # normalize_url also drops the fragment
+    parsed = urlparse.urlparse(normalize_url(url))
+    query = [(name, value) for name, value
+             in urlparse.parse_qsl(parsed.query, keep_blank_values=True)
+             if not (name.lower().startswith("utm_")
+                     or name.lower() in TRACKING_PARAMS)]
+    return urlparse.urlunparse(parsed[:4] + (urllib.urlencode(query), ""))
+
+class BloomFilter:
+    # a set of strings in a fixed number of bits, sized so that with
+    # capacity members a string not added is reported as a member with
+    # probability error_rate. Members are never reported missing.
+    def __init__(self, capacity, error_rate=0.001):
+        self.bits = int(math.ceil(-capacity * math.log(error_rate)
+                                  / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits * math.log(2) / capacity)))
+        self.__array = bytearray((self.bits + 7) // 8)
+
+    def __positions(self, key):
+        # the positions are h1 + i*h2, two hashes standing in for k
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        return all(self.__array[pos >> 3] & (1 << (pos & 7))
+                   for pos in self.__positions(key))
+
+    # adds key, returns False if it was a member already
+    def add(self, key):
+        added = False
+        for pos in self.__positions(key):
+            if not self.__array[pos >> 3] & (1 << (pos & 7)):
+                self.__array[pos >> 3] |= 1 << (pos & 7)
+                added = True
+        return added
+
+class VisitedIndex:
+    # the canonical form of every url tested in the run. The coordinator
+    # serves a single one to all its workers, whose calls come in on
+    # threads of its manager.
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.__urls = BloomFilter(capacity, error_rate)
+        self.__lock = threading.Lock()
+
+    def __key(self, url):
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+        return canonical_url(url)
+
+    # marks url as tested, returns False if it was already
+    def add(self, url):
+        key = self.__key(url)
+        with self.__lock:
+            return self.__urls.add(key)
+
+    # not __contains__, the manager's proxies do not pass that on
+    def contains(self, url):
+        key = self.__key(url)
+        with self.__lock:
+            return key in self.__urls